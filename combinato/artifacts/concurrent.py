@@ -7,28 +7,91 @@
 
 from __future__ import print_function, division
 import os
+from multiprocessing import Pool, cpu_count
 import numpy as np
 import tables
-import time
 from .. import NcsFile, h5files, get_regions
 
 DEBUG = True
 BIN_MS = 3 
 
-def bincount(ts_beg, ts_end, files, sign='pos'):
 
-    bins = np.arange(ts_beg, ts_end, BIN_MS)
-    count = np.zeros(len(bins) - 1, 'uint16')
-    nch = 0 # how many channels contribute?
-    for i, fn in enumerate(files):
-        times = times_from_file(fn, sign) 
-        if len(times):
-            nch += 1 
-            count += (np.histogram(times, bins)[0] > 0)
-            if DEBUG:
-                print('Added {}/{}'.format(i + 1, len(files)))
+def n_bins_between(ts_beg, ts_end, bin_ms=BIN_MS):
+    """
+    number of bins of np.arange(ts_beg, ts_end, bin_ms),
+    without creating the array
+    """
+    return max(int(np.ceil((ts_end - ts_beg)/bin_ms)) - 1, 0)
+
+
+def bin_index(times, ts_beg, n_bins, bin_ms=BIN_MS):
+    """
+    bin of each time, the same as in np.histogram(times, bins) with
+    bins = np.arange(ts_beg, ts_end, bin_ms), -1 for times outside
+    """
+    # np.arange computes edge i as ts_beg + i * delta
+    delta = (ts_beg + bin_ms) - ts_beg
+    times = np.asarray(times, dtype=float)
+
+    idx = np.floor((times - ts_beg)/delta).astype(np.int64)
+    # correct rounding errors at the edges
+    idx[times < ts_beg + idx * delta] -= 1
+    idx[times >= ts_beg + (idx + 1) * delta] += 1
+    # the last bin includes its right edge
+    idx[times == ts_beg + n_bins * delta] = n_bins - 1
+    idx[(idx < 0) | (idx >= n_bins)] = -1
+
+    return idx
+
+
+def occupied_bins(args):
+    """
+    multiprocessing helper, returns the bins
+    that contain spikes from one file
+    """
+    fname, sign, ts_beg, n_bins = args
+    times = times_from_file(fname, sign)
+    if not len(times):
+        return fname, None
 
-    return count, bins, nch 
+    idx = bin_index(times, ts_beg, n_bins)
+    return fname, np.unique(idx[idx >= 0])
+
+
+def bincount_sparse(ts_beg, ts_end, files, sign='pos', n_workers=1):
+    """
+    same as bincount, but only bins that contain spikes are returned,
+    files are read by n_workers processes.
+    returns bin indices, counts, number of bins, and number of channels
+    """
+    n_bins = n_bins_between(ts_beg, ts_end)
+    jobs = [(fname, sign, ts_beg, n_bins) for fname in files]
+
+    if n_workers > 1:
+        pool = Pool(n_workers)
+        results = pool.imap_unordered(occupied_bins, jobs)
+    else:
+        results = (occupied_bins(job) for job in jobs)
+
+    all_bins = []
+    for i, (fname, bins) in enumerate(results):
+        if bins is not None:
+            all_bins.append(bins)
+        if DEBUG:
+            print('Added {}/{} {}'.format(i + 1, len(files), fname))
+
+    if n_workers > 1:
+        pool.close()
+        pool.join()
+
+    nch = len(all_bins)
+    if not nch:
+        return (np.zeros(0, np.int64), np.zeros(0, 'uint16'), n_bins, nch)
+
+    # the counts of occupied bins only
+    bin_idx, count = np.unique(np.hstack(all_bins), return_counts=True)
+
+    return bin_idx, count.astype('uint16'), n_bins, nch
 
 
 def _any_from_file(what, fname, sign='pos'):
@@ -76,7 +139,7 @@ def times_from_file(fname, sign='pos'):
 
 
 
-def write_bincount(folder):
+def write_bincount(folder, n_workers=1):
     """
     get count for bin, save to file
     """
@@ -106,16 +169,29 @@ def write_bincount(folder):
 
     print(ts_beg, ts_end, (ts_end - ts_beg)/1000/60)
 
-    count, bins, nch = bincount(ts_beg, ts_end, files)
+    bin_idx, bin_count, n_bins, nch = bincount_sparse(ts_beg, ts_end, files,
+                                                      n_workers=n_workers)
+    # only bins with spikes are stored
     outfile = tables.open_file(outfname, 'w')
-    outfile.create_array('/', 'count', count)
-    outfile.root.count.attrs['nch'] = nch
-    outfile.root.count.attrs['start'] = ts_beg
-    outfile.root.count.attrs['stop'] = ts_end
-    outfile.root.count.attrs['binms'] = BIN_MS 
+    outfile.create_array('/', 'bin_index', bin_idx)
+    outfile.create_array('/', 'bin_count', bin_count)
+    attrs = outfile.root.bin_count.attrs
+    attrs['nch'] = nch
+    attrs['start'] = ts_beg
+    attrs['stop'] = ts_end
+    attrs['binms'] = BIN_MS
+    attrs['nbins'] = n_bins
     outfile.close()
 
 
 def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser('css-find-concurrent',
+                            description='Counts channels with spikes in '
+                                        'short time bins')
+    parser.add_argument('--workers', type=int, default=cpu_count(),
+                        help='number of files read at the same time')
+    args = parser.parse_args()
+
     folder = os.getcwd()
-    write_bincount(folder)
+    write_bincount(folder, max(1, args.workers))
@@ -9,7 +9,10 @@ different functions can be called to mark artifacts
 
 from __future__ import print_function, division, absolute_import
 import os
+import time
+import hashlib
 from argparse import ArgumentParser
+from multiprocessing import Pool, Semaphore
 
 import numpy as np
 import tables
@@ -21,6 +24,17 @@ DEBUG = True
 RESET = True  # set artifacts to 0 before analysis
 READONLY = False
 MODE = 'first'  # MODE can be 'first', 'last', or 'OR'
+CHUNK_SIZE = 100 * 1000  # spikes read at once
+
+# raw detector outputs are stored per sign in this group
+DETECTOR_GROUP = 'artifact_detectors'
+# index of spikes whose artifact code changed in the last run
+CHANGES_NAME = 'changed'
+# number of changed spikes listed in the printout
+N_CHANGES_PRINT = 20
+
+# worker-pool mode: limits the number of workers that read at the same time
+_io_lock = None
 
 
 options_by_diff = {'art_id': 1,   # to identify this type of artifact
@@ -84,17 +98,81 @@ def add_id(artifacts, index, art_id, sign):
     print('Total: ', (artifacts[:] != 0).sum())
 
 
+def merge_intervals(starts, stops):
+    """
+    merges overlapping closed intervals [starts[i], stops[i]],
+    returns starts and stops of the merged intervals, sorted
+    """
+    starts = np.asarray(starts, dtype=float)
+    stops = np.asarray(stops, dtype=float)
+    # empty intervals mark nothing
+    valid = stops >= starts
+    starts = starts[valid]
+    stops = stops[valid]
+
+    if not starts.shape[0]:
+        return starts, stops
+
+    order = np.argsort(starts, kind='mergesort')
+    starts = starts[order]
+    ends = np.maximum.accumulate(stops[order])
+
+    # an interval starts a new merged interval if it begins
+    # after all previous intervals have ended
+    is_first = np.ones(starts.shape[0], dtype=bool)
+    is_first[1:] = starts[1:] > ends[:-1]
+    is_last = np.ones(starts.shape[0], dtype=bool)
+    is_last[:-1] = is_first[1:]
+
+    return starts[is_first], ends[is_last]
+
+
+def mark_intervals(times, starts, stops):
+    """
+    marks all times that are in at least one of the closed
+    intervals [starts[i], stops[i]]. Overlapping intervals are merged,
+    and each merged interval is mapped to a range of indices
+    with np.searchsorted
+    """
+    num_spk = times.shape[0]
+    starts, stops = merge_intervals(starts, stops)
+
+    if (not num_spk) or (not starts.shape[0]):
+        return np.zeros(num_spk, dtype=bool)
+
+    if (np.diff(times) >= 0).all():
+        sorted_times = times
+        time_order = None
+    else:
+        time_order = np.argsort(times, kind='mergesort')
+        sorted_times = times[time_order]
+
+    first_idx = np.searchsorted(sorted_times, starts, 'left')
+    stop_idx = np.searchsorted(sorted_times, stops, 'right')
+
+    delta = np.zeros(num_spk + 1, dtype=np.int64)
+    np.add.at(delta, first_idx, 1)
+    np.add.at(delta, stop_idx, -1)
+    marked = np.cumsum(delta[:-1]) > 0
+
+    if time_order is None:
+        return marked
+
+    artifacts = np.zeros(num_spk, dtype=bool)
+    artifacts[time_order] = marked
+    return artifacts
+
+
 def mark_range_detection(times, ranges):
     """
     Ranges contains a list of 2-tuples. All timestamps within
     such a 2-tuple are excluded.
     """
-    artifacts = np.zeros(times.shape[0], dtype=bool)
-    for this_range in ranges:
-        idx = (times >= this_range[0]) & (times <= this_range[1])
-        print(this_range, times[0], times[-1])
-        print(idx.sum())
-        artifacts[idx] |= True
+    ranges = np.array(ranges, dtype=float).reshape(-1, 2)
+    artifacts = mark_intervals(times, ranges[:, 0], ranges[:, 1])
+    if DEBUG:
+        print('{} ranges, {} spikes'.format(ranges.shape[0],
+                                             artifacts.sum()))
 
     return artifacts, options_ranges['art_id']
 
@@ -102,31 +180,34 @@ def mark_range_detection(times, ranges):
 def mark_double_detection(times, spikes, sign):
     """
     for spikes that are too close together,
-    keep only the one with the bigger amplitude
+    keep only the one with the bigger amplitude.
+    Each close pair is decided on its own, so in chains of
+    close spikes, several spikes can be marked.
+    spikes can be an h5 node, only one column is read,
+    or the relevant_idx column itself
     """
+    min_dist = options_double['min_dist']
+    rel_idx = options_double['relevant_idx']
+
+    artifacts = np.zeros(times.shape[0], dtype=bool)
+    double_idx = (np.diff(times) < min_dist).nonzero()[0]
+
+    if double_idx.shape[0]:
+        values = spikes if len(spikes.shape) == 1 else spikes[:, rel_idx]
+        first = values[double_idx]
+        second = values[double_idx + 1]
 
-    def mycmp(a, b, sign):
         if sign == 'pos':
-            return a > b
+            keep_first = first > second
         elif sign == 'neg':
-            return a < b
-
-    artifacts = np.zeros(times.shape[0], dtype=bool)
-    min_dist = options_double['min_dist']
-    rel_idx = options_double['relevant_idx']
-    diff = np.diff(times)
-    double_idx = diff < min_dist
-
-    for i in double_idx.nonzero()[0]:
-        sp1 = spikes[i, rel_idx]
-        sp2 = spikes[i + 1, rel_idx]
-        if mycmp(sp1, sp2, sign):
-            kill = i + 1
+            keep_first = first < second
         else:
-            kill = i
+            raise ValueError('Unknown sign: ' + sign)
+
+        kill = np.where(keep_first, double_idx + 1, double_idx)
         artifacts[kill] = True
 
-    print('{} dist < {}'.format((double_idx).sum(), min_dist))
+    print('{} dist < {}'.format(double_idx.shape[0], min_dist))
     return artifacts, options_double['art_id']
 
 
@@ -145,159 +226,350 @@ def mark_by_diff(times):
             continue
         counts, _ = np.histogram(times, bins)
         left_edges_too_many = bins[:-1][counts > max_per_bin]
-        # try a loop, but maybe too slow?
         if DEBUG:
-            print('looping over {} edges'.format(left_edges_too_many.shape[0]))
-        for edge in left_edges_too_many:
-            idx = (times >= edge) & (times <= edge + bin_len)
-            artifacts[idx] = True
+            print('marking {} edges'.format(left_edges_too_many.shape[0]))
+        artifacts |= mark_intervals(times, left_edges_too_many,
+                                    left_edges_too_many + bin_len)
 
     return artifacts, options_by_diff['art_id']
 
 
-def bincount_to_edges(concurrent_fname):
+def bincount_to_intervals(concurrent_fname):
     """
-    helper, transforms bincount to edges
+    reads bins with events in too many channels from a file
+    written by css-find-concurrent, returns them as merged
+    intervals (starts, stops). Files with sparse counts (bin_index,
+    bin_count) and files with dense counts (count) can be read
     """
     conc_fid = tables.open_file(concurrent_fname, 'r')
-    count = conc_fid.root.count[:]
-    attrs = conc_fid.root.count.attrs
+    if 'bin_index' in conc_fid.root:
+        bin_idx = conc_fid.root.bin_index[:]
+        count = conc_fid.root.bin_count[:]
+        attrs = conc_fid.root.bin_count.attrs
+    else:
+        count = conc_fid.root.count[:]
+        bin_idx = count.nonzero()[0]
+        count = count[bin_idx]
+        attrs = conc_fid.root.count.attrs
     num_channels = attrs['nch']
     start = attrs['start']
-    stop = attrs['stop']
     bin_len = attrs['binms']
     conc_fid.close()
-    bins = np.arange(start, stop, bin_len)
+
     cutoff = options_by_bincount['max_frac_ch'] * num_channels
     if DEBUG:
         print('Using cutoff of {:.0f} channels'.format(cutoff))
-    exclusion_left_edges = bins[:-1][count > cutoff]
-    return exclusion_left_edges, bin_len
+
+    # left edges as in np.arange(start, stop, bin_len)
+    delta = (start + bin_len) - start
+    left_edges = start + bin_idx[count > cutoff] * delta
+    return merge_intervals(left_edges, left_edges + bin_len)
 
 
-def mark_by_bincount(times, left_edges, bin_len):
+def mark_by_bincount(times, starts, stops):
     """
-    marks bins with events in too many other channels (specified by counts)
+    marks intervals with events in too many other channels
+    (from bincount_to_intervals)
     """
     if DEBUG:
-        print('all channel rejection, looping over {} edges'.
-              format(left_edges.shape[0]))
-
-    artifacts = np.zeros(times.shape[0], dtype=bool)
+        print('all channel rejection, marking {} intervals'.
+              format(starts.shape[0]))
 
-    for edge in left_edges:
-        idx = (times >= edge) & (times <= edge + bin_len)
-        artifacts[idx] = True
+    artifacts = mark_intervals(times, starts, stops)
 
     return artifacts, options_by_bincount['art_id']
 
 
+def spike_summary(spike_node, sign, chunk_size=CHUNK_SIZE):
+    """
+    reads spikes once, in chunks, and keeps only what the
+    detectors need: the extremum of each spike (maximum for
+    positive, minimum for negative spikes) and the relevant_idx column
+    """
+    num_spk = spike_node.shape[0]
+    rel_idx = options_double['relevant_idx']
+    extrema = np.empty(num_spk, spike_node.dtype)
+    column = np.empty(num_spk, spike_node.dtype)
+
+    for start in range(0, num_spk, chunk_size):
+        stop = min(start + chunk_size, num_spk)
+        block = spike_node[start:stop]
+        if sign == 'pos':
+            extrema[start:stop] = block.max(1)
+        elif sign == 'neg':
+            extrema[start:stop] = block.min(1)
+        else:
+            raise ValueError('Unknown sign: ' + sign)
+        column[start:stop] = block[:, rel_idx]
+
+    return extrema, column
+
+
 def mark_by_height(spikes, sign):
     """
     marks spikes that exceed a height criterion
+    spikes can also be the extrema from spike_summary
     """
     max_height = options_by_height['max_height']
 
+    if len(spikes.shape) == 2:
+        spikes = spikes.max(1) if sign == 'pos' else spikes.min(1)
+
     if sign == 'pos':
-        artifacts = spikes.max(1) >= max_height
+        artifacts = spikes >= max_height
     elif sign == 'neg':
-        artifacts = spikes.min(1) <= -max_height
+        artifacts = spikes <= -max_height
     else:
         raise ValueError('Unknown sign: ' + sign)
 
     return artifacts, options_by_height['art_id']
 
 
-def main(fname, concurrent_edges=None, concurrent_bin=None,
-         exlude_ranges=None):
+def detector_signature(options, extra=None):
+    """
+    identifies the options, and other inputs, of a detector
+    """
+    signature = repr(sorted(options.items()))
+    if extra is not None:
+        data = np.ascontiguousarray(extra, dtype=float)
+        signature += ' ' + hashlib.md5(data.tobytes()).hexdigest()
+    return signature
+
+
+def read_detector(h5fid, sign, name, signature, num_spk):
+    """
+    returns the stored output of a detector, or None if there is
+    none for this signature and number of spikes
+    """
+    try:
+        node = h5fid.get_node('/{}/{}'.format(sign, DETECTOR_GROUP), name)
+    except tables.NoSuchNodeError:
+        return None
+
+    if (node.attrs['signature'] != signature) or\
+            (node.attrs['nspk'] != num_spk):
+        return None
+
+    return np.unpackbits(node[:])[:num_spk].astype(bool)
+
+
+def write_detector(h5fid, sign, name, signature, marks):
+    """
+    stores the output of a detector, bit-packed
+    """
+    where = '/{}/{}'.format(sign, DETECTOR_GROUP)
+    if where not in h5fid:
+        h5fid.create_group('/' + sign, DETECTOR_GROUP)
+    if name in h5fid.get_node(where):
+        h5fid.remove_node(where, name)
+
+    node = h5fid.create_array(where, name, np.packbits(marks))
+    node.attrs['signature'] = signature
+    node.attrs['nspk'] = marks.shape[0]
+
+
+def report_changes(old, new, sign):
+    """
+    prints how many spikes changed their artifact state,
+    returns the index of these spikes
+    """
+    marked = (old == 0) & (new != 0)
+    unmarked = (old != 0) & (new == 0)
+    recoded = (old != 0) & (new != 0) & (old != new)
+
+    print('{}: {} spikes newly marked, {} unmarked, {} with a different '
+          'artifact code'.format(sign, marked.sum(), unmarked.sum(),
+                                 recoded.sum()))
+    if marked.any() or unmarked.any():
+        print('{}: spikes used for sorting changed, sorting sessions '
+              'have to be prepared again'.format(sign))
+
+    changed = (marked | unmarked | recoded).nonzero()[0]
+    if changed.shape[0]:
+        more = '' if changed.shape[0] <= N_CHANGES_PRINT else ' ...'
+        print('{}: changed spikes: {}{}'.format(
+            sign, ' '.join(str(i) for i in changed[:N_CHANGES_PRINT]), more))
+
+    return changed
+
+
+def write_changes(h5fid, sign, changed):
+    """
+    stores the index of spikes whose artifact code changed
+    """
+    where = '/{}/{}'.format(sign, DETECTOR_GROUP)
+    if where not in h5fid:
+        h5fid.create_group('/' + sign, DETECTOR_GROUP)
+    if CHANGES_NAME in h5fid.get_node(where):
+        h5fid.remove_node(where, CHANGES_NAME)
+
+    h5fid.create_array(where, CHANGES_NAME, changed)
+
+
+def main(fname, concurrent_starts=None, concurrent_stops=None,
+         exlude_ranges=None, changed_only=False):
     """
     creates table to store artifact information
+    spikes are read once, artifacts are written once per sign.
+    The output of each detector is stored; with changed_only,
+    detectors whose options and inputs are unchanged are not run again,
+    and the artifacts are combined from stored outputs
+    returns the time spent waiting for the I/O lock,
+    reading, and in total (seconds)
     """
-    for sign in SIGNS:
+    start_time = time.time()
+    wait_time = 0
+    read_time = 0
 
-        # why is this here?
-        if READONLY:
-            mode = 'r'
-        else:
-            mode = 'r+'
-        h5fid = tables.open_file(fname, mode)
+    if READONLY:
+        mode = 'r'
+    else:
+        mode = 'r+'
+    h5fid = tables.open_file(fname, mode)
 
+    for sign in SIGNS:
         try:
             node = h5fid.get_node('/' + sign + '/times')
         except tables.NoSuchNodeError:
             print('{} has no {} spikes'.format(fname, sign))
-            h5fid.close()
             continue
 
         if len(node.shape) == 0:
-            h5fid.close()
             continue
 
         elif node.shape[0] == 0:
-            h5fid.close()
             continue
 
-        times = node[:]
-        num_spk = times.shape[0]
+        num_spk = node.shape[0]
 
-        spikes = h5fid.get_node('/' + sign, 'spikes')[:, :]
+        # detectors in the order in which they are combined
+        detectors = [(options_by_diff, None),
+                     (options_by_height, None),
+                     (options_double, None)]
+        if concurrent_starts is not None:
+            detectors.append((options_by_bincount,
+                              np.hstack((concurrent_starts,
+                                         concurrent_stops))))
+        if exlude_ranges is not None:
+            detectors.append((options_ranges, exlude_ranges))
+
+        signatures = {}
+        outputs = {}
+        for det_options, extra in detectors:
+            name = det_options['name']
+            signatures[name] = detector_signature(det_options, extra)
+            if changed_only:
+                marks = read_detector(h5fid, sign, name, signatures[name],
+                                      num_spk)
+                if marks is not None:
+                    outputs[name] = marks
+
+        need_spikes = (options_by_height['name'] not in outputs) or\
+            (options_double['name'] not in outputs)
+
+        wait_start = time.time()
+        if _io_lock is not None:
+            _io_lock.acquire()
+        read_start = time.time()
+        wait_time += read_start - wait_start
 
-        assert num_spk == spikes.shape[0]
+        try:
+            times = node[:]
+
+            if need_spikes:
+                spike_node = h5fid.get_node('/' + sign, 'spikes')
+                assert num_spk == spike_node.shape[0]
+
+                extrema, column = spike_summary(spike_node, sign)
+        finally:
+            if _io_lock is not None:
+                _io_lock.release()
+
+        read_time += time.time() - read_start
+
+        run = {options_by_diff['name']:
+               lambda: mark_by_diff(times),
+               options_by_height['name']:
+               lambda: mark_by_height(extrema, sign),
+               options_double['name']:
+               lambda: mark_double_detection(times, column, sign),
+               options_by_bincount['name']:
+               lambda: mark_by_bincount(times, concurrent_starts,
+                                        concurrent_stops),
+               options_ranges['name']:
+               lambda: mark_range_detection(times, exlude_ranges)}
+
+        for det_options, _ in detectors:
+            name = det_options['name']
+            if name in outputs:
+                if DEBUG:
+                    print('{}: using stored output for {} spikes'.
+                          format(name, sign))
+                continue
+
+            outputs[name], _ = run[name]()
+            if not READONLY:
+                write_detector(h5fid, sign, name, signatures[name],
+                               outputs[name])
 
         try:
-            artifacts = h5fid.get_node('/' + sign + '/artifacts')
+            art_node = h5fid.get_node('/' + sign + '/artifacts')
         except tables.NoSuchNodeError:
-            h5fid.create_array('/' + sign, 'artifacts',
-                               atom=tables.Int8Atom(), shape=(num_spk, ))
-            artifacts = h5fid.get_node('/' + sign + '/artifacts')
+            art_node = None
+
+        old_artifacts = np.zeros(num_spk, dtype=np.int8)
+        if art_node is not None:
+            # the data file may have grown since the last run
+            n_old = min(art_node.shape[0], num_spk)
+            old_artifacts[:n_old] = art_node[:n_old]
+
         if RESET:
-            artifacts[:] = 0
-
-        arti_by_diff, arti_by_diff_id = mark_by_diff(times)
-        add_id(artifacts, arti_by_diff, arti_by_diff_id, sign)
-        # artifacts[arti_by_diff != 0] = arti_by_diff_id
-
-        # if DEBUG:
-        #    print('Marked {} {} spikes by diff'.
-        #          format(arti_by_diff.sum(), sign))
-
-        arti_by_height, arti_by_height_id = mark_by_height(spikes, sign)
-        add_id(artifacts, arti_by_height, arti_by_height_id, sign)
-
-        # artifacts[arti_by_height != 0] = arti_by_height_id
-        # if DEBUG:
-        #    print('Marked {} {} spikes by height'.
-        #          format(arti_by_height.sum(), sign))
-
-        arti_by_double, double_id = mark_double_detection(times, spikes, sign)
-        add_id(artifacts, arti_by_double, double_id, sign)
-        # artifacts[arti_by_double != 0] = double_id
-        # if DEBUG:
-        #    print('Marked {} {} spikes as detected twice'.
-        #          format(arti_by_double.sum(), sign))
-
-        if concurrent_edges is not None:
-            arti_by_conc, arti_by_conc_id = mark_by_bincount(times,
-                                                             concurrent_edges,
-                                                             concurrent_bin)
-            add_id(artifacts, arti_by_conc, arti_by_conc_id, sign)
-
-            # artifacts[arti_by_conc != 0] = arti_by_conc_id
-            # if DEBUG:
-            #    print('Marked {} {} spikes by concurrent occurence'.
-            #          format(arti_by_conc.sum(), sign))
+            artifacts = np.zeros(num_spk, dtype=np.int8)
+        else:
+            artifacts = old_artifacts.copy()
 
-        if exlude_ranges is not None:
-            arti_by_ranges, range_id = mark_range_detection(times,
-                                                            exlude_ranges)
-            add_id(artifacts, arti_by_ranges, range_id, sign)
-            # artifacts[arti_by_ranges != 0] = range_id
+        for det_options, _ in detectors:
+            add_id(artifacts, outputs[det_options['name']],
+                   det_options['art_id'], sign)
 
-            # if DEBUG:
-            #    print('Marked {} {} spikes within supplied range '.
-            #          format(arti_by_ranges.sum(), sign))
+        changed = report_changes(old_artifacts, artifacts, sign)
+
+        if READONLY:
+            continue
+
+        write_changes(h5fid, sign, changed)
+
+        # one bulk write
+        if (art_node is not None) and (art_node.shape[0] != num_spk):
+            h5fid.remove_node('/' + sign, 'artifacts')
+            art_node = None
+
+        if art_node is None:
+            h5fid.create_array('/' + sign, 'artifacts', artifacts)
+        else:
+            art_node[:] = artifacts
 
-        h5fid.close()
+    h5fid.close()
+    total_time = time.time() - start_time
+    print('{}: waited {:.1f} s, read {:.1f} s, total {:.1f} s'.
+          format(fname, wait_time, read_time, total_time))
+    return wait_time, read_time, total_time
+
+
+def _init_worker(io_lock):
+    """
+    pool initializer, shares the I/O semaphore with the workers
+    """
+    global _io_lock
+    _io_lock = io_lock
+
+
+def _main_helper(args):
+    """
+    multiprocessing helper
+    """
+    fname = args[0]
+    return fname, main(*args)
 
 
 def parse_args():
@@ -307,6 +579,14 @@ def parse_args():
     parser.add_argument('--concurrent-file', nargs=1)
     parser.add_argument('--exclude-ranges', nargs=1,
                         help='supply a file with timestamp ranges to exclude')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of files processed at the same time')
+    parser.add_argument('--io-jobs', type=int, default=1,
+                        help='number of workers that may read spikes at '
+                             'the same time (with --workers)')
+    parser.add_argument('--changed-only', default=False, action='store_true',
+                        help='run only detectors whose options changed, '
+                             'use stored outputs of the others')
     args = parser.parse_args()
 
     if args.concurrent_file:
@@ -315,11 +595,11 @@ def parse_args():
         conc_fname = CONC_FNAME
 
     if os.path.isfile(conc_fname):
-        concurrent_edges, concurrent_bin =\
-            bincount_to_edges(conc_fname)
+        concurrent_starts, concurrent_stops =\
+            bincount_to_intervals(conc_fname)
     else:
         print('Not using concurrent spike detection')
-        concurrent_edges = concurrent_bin = None
+        concurrent_starts = concurrent_stops = None
 
     if args.file:
         fname = args.file[0]
@@ -341,12 +621,37 @@ def parse_args():
     else:
         exclude_ranges = None
 
-    # main loop, could be done with parallel
-    # processing (bad because of high I/O)
-    for fname in files:
+    jobs = [(fname, concurrent_starts, concurrent_stops, exclude_ranges,
+             args.changed_only) for fname in files]
+    start_time = time.time()
+
+    if args.workers > 1:
+        # reading is limited separately from computing,
+        # so that storage is not thrashed
+        io_jobs = max(1, min(args.io_jobs, args.workers))
+        print('Starting {} workers, {} reading at the same time'.
+              format(args.workers, io_jobs))
+        pool = Pool(args.workers, _init_worker, (Semaphore(io_jobs), ))
+        results = pool.imap_unordered(_main_helper, jobs)
+    else:
+        results = (_main_helper(job) for job in jobs)
+
+    total_wait = 0
+    total_read = 0
+    for count, (fname, times) in enumerate(results):
+        total_wait += times[0]
+        total_read += times[1]
         if DEBUG:
-            print('Starting ' + fname)
-        main(fname, concurrent_edges, concurrent_bin, exclude_ranges)
+            print('Finished {}/{}: {}'.format(count + 1, len(jobs), fname))
+
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+
+    print('{} files in {:.1f} s, {:.1f} s spent reading, {:.1f} s waiting '
+          'to read'.format(len(jobs), time.time() - start_time, total_read,
+                           total_wait))
+
 
 if __name__ == "__main__":
     parse_args()
@@ -58,6 +58,14 @@ def nev_string_read(filename):
     return np.array([eventmap['timestamp'], eventmap['ev_string']]).T
 
 
+def ncs_memmap(filename):
+    """
+    memory-mapped records of a .ncs file
+    """
+    return np.memmap(filename, dtype=ncs_type, mode='r', offset=NLX_OFFSET,
+                     shape=(ncs_num_recs(filename),))
+
+
 class NcsFile(object):
     """
     represents ncs files, allows to read data and time
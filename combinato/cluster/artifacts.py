@@ -9,6 +9,7 @@ artifact clusters based on the spike wave forms
 from __future__ import print_function, division, absolute_import
 import numpy as np
 from .. import options, artifact_criteria
+from .grouped_stats import grouped_stats
 
 CRIT = artifact_criteria
 TOLERANCE = 10
@@ -58,19 +59,29 @@ def peak_to_peak(data):
     peak to peak ratio in second half. data: mean spike
     """
     cut = int(data.shape[0]/2)
-    return (data[cut:] - data[0]).ptp()/data.max()
+    return np.ptp(data[cut:] - data[0])/data.max()
 
 
 def artifact_score(data):
     """
     runs all of the above tests
     """
-    # could use a list of functions, but not really necessary
     mean = data.mean(0)
+    std_err = std_err_mean(data)
+    score, reasons = artifact_score_from_stats(mean, std_err)
+
+    # return mean for convenience
+    return score, reasons, mean
 
+
+def artifact_score_from_stats(mean, std_err):
+    """
+    runs all of the above tests, given the mean spike
+    and the standard error of the mean
+    """
+    # could use a list of functions, but not really necessary
     num_peaks, peak_ratio = find_maxima_ratio(mean, TOLERANCE)
     ratio = max_min_ratio(mean)
-    std_err = std_err_mean(data)
     ptp = peak_to_peak(mean)
 
     score = 0
@@ -96,30 +107,106 @@ def artifact_score(data):
         score += 1
         reasons.append('ptp')
 
-    # return mean for convenience
-    return score, reasons, mean
+    return score, reasons
+
+
+def find_maxima_ratio_batch(data, tolerance):
+    """
+    find_maxima_ratio for each row of data (mean spikes)
+    """
+    n_rows, n_samp = data.shape
+    is_peak = np.zeros(data.shape, bool)
+    is_peak[:, 1:-1] = (data[:, 1:-1] > data[:, :-2]) &\
+        (data[:, 1:-1] > data[:, 2:])
+
+    # position of the next peak to the right (or the end)
+    cols = np.arange(n_samp)
+    positions = np.where(is_peak, cols, n_samp)
+    next_peak = np.full(data.shape, n_samp)
+    next_peak[:, :-1] = np.minimum.accumulate(positions[:, :0:-1],
+                                              axis=1)[:, ::-1]
+
+    # exclude nearby peaks
+    kept = is_peak & (next_peak - cols >= tolerance)
+    num = kept.sum(1)
+
+    vals = np.where(kept, data, -np.inf)
+    vals.sort(1)
+    ratio = np.full(n_rows, np.inf)
+    many = num > 1
+    ratio[many] = np.abs(vals[many, -1]/vals[many, -2])
+
+    return num, ratio
+
+
+def artifact_score_batch(means, std_errs):
+    """
+    runs all tests for each row of means,
+    returns scores and reasons
+    """
+    num_peaks, peak_ratio = find_maxima_ratio_batch(means, TOLERANCE)
+    ratio = np.abs(means.max(1)/means.min(1))
+    cut = int(means.shape[1]/2)
+    ptp = np.ptp(means[:, cut:] - means[:, :1], axis=1)/means.max(1)
+
+    tests = (('maxima', num_peaks > CRIT['maxima']),
+             ('maxima_1_2_ratio', peak_ratio < CRIT['maxima_1_2_ratio']),
+             ('max_min_ratio', ratio < CRIT['max_min_ratio']),
+             ('sem', std_errs > CRIT['sem']),
+             ('ptp', ptp > CRIT['ptp']))
+
+    scores = np.zeros(means.shape[0], int)
+    reasons = [[] for _ in range(means.shape[0])]
+
+    for name, result in tests:
+        scores += result
+        for row in result.nonzero()[0]:
+            reasons[row].append(name)
+
+    return scores, reasons
+
+
+def find_artifacts_from_stats(stats, class_ids, invert=False):
+    """
+    identifies artifacts from grouped statistics,
+    returns a score for each row of stats and the artifact ids
+    """
+    scores = np.zeros(stats.ids.shape[0], np.uint8)
+    pos, found = stats.positions(class_ids)
+    class_ids = np.asarray(class_ids)
+    sel = found & (class_ids != 0)
+    rows = pos[sel]
+
+    if not rows.shape[0]:
+        return scores, []
+
+    means = -stats.means[rows] if invert else stats.means[rows]
+    std_errs = np.sqrt(stats.variances[rows]).mean(1) /\
+        np.sqrt(stats.counts[rows])
+    row_scores, reasons = artifact_score_batch(means, std_errs)
+
+    if options['Debug']:
+        for class_id, score, reason in zip(class_ids[sel], row_scores,
+                                           reasons):
+            print(class_id, score, reason)
+
+    scores[rows] = row_scores
+    artifact_ids = list(class_ids[sel][row_scores > 0])
+
+    return scores, artifact_ids
 
 
 def find_artifacts(spikes, sorted_idx, class_ids, invert=False):
     """
     identifies artifacts
     """
-    artifact_idx = np.zeros(spikes.shape[0], np.uint8)
-    artifact_ids = []
-
-    for class_id in class_ids:
-        if class_id == 0:
-            continue
-        class_idx = sorted_idx == class_id
-        class_spikes = spikes[class_idx]
-        if invert:
-            class_spikes = -class_spikes
-        score, reasons, _ = artifact_score(class_spikes)
-        if options['Debug']:
-            print(class_id, score, reasons)
-        artifact_idx[class_idx] = score
-        if score:
-            artifact_ids.append(class_id)
+    # means and standard deviations of all classes in one pass
+    stats = grouped_stats(sorted_idx, spikes)
+    if stats.ids is None:
+        return np.zeros(spikes.shape[0], np.uint8), []
+
+    scores, artifact_ids = find_artifacts_from_stats(stats, class_ids, invert)
+    artifact_idx = scores[np.searchsorted(stats.ids, sorted_idx)]
 
     return artifact_idx, artifact_ids
 
@@ -5,6 +5,8 @@ main program for spike sorting
 
 from __future__ import print_function, division, absolute_import
 import os
+from functools import partial
+from multiprocessing.pool import ThreadPool
 import numpy as np
 # pylint:   disable=E1101
 from .. import SortingManager, SessionManager, options
@@ -13,18 +15,26 @@ from getpass import getuser
 
 import matplotlib.pyplot as mpl
 
-from .wave_features import wavelet_features
+from .wave_features import wavelet_features, stored_features
 from .select_features import select_features
 from .define_clusters import define_clusters
 from .cluster_features import cluster_features, read_results
 from .dist import template_match
 from .artifacts import find_artifacts
 from .plot_temp import plot_temperatures
+from .scheduler import run_jobs
 
 
 USER = getuser()
 LOG_FNAME = 'log.txt'
 FIRST_MATCH_FACTOR = options['FirstMatchFactor']
+# number of reclustering steps that run concurrently within one session
+RECLUSTER_WORKERS = 1
+# coreset mode: spikes outside the clustered subsample are matched
+# with this factor. Smaller coresets are faster to cluster, but
+# small clusters may be missed and more spikes stay unassigned
+CORESET_MATCH_FACTOR = FIRST_MATCH_FACTOR
+CORESET_SEED = 0
 
 
 def features_to_index(features, folder, name, overwrite=True):
@@ -73,6 +83,14 @@ def cluster_step(features, folder, sub_name, overwrite):
                                                    folder,
                                                    sub_name,
                                                    overwrite)
+    finish_step(res_idx, tree, used_points, folder, sub_name)
+    return res_idx
+
+
+def finish_step(res_idx, tree, used_points, folder, sub_name):
+    """
+    plots and reports the result of a clustering step
+    """
     # save temperature plot here if wanted
     if options['plotTemps']:
         temp_fig = plot_temperatures(tree, used_points)
@@ -85,12 +103,46 @@ def cluster_step(features, folder, sub_name, overwrite):
         for clid in np.unique(res_idx):
             print('{}: {} spikes'.format(clid, (res_idx == clid).sum()))
 
-    return res_idx
 
+def recluster_steps(features, folder, jobs, overwrite, n_workers=1):
+    """
+    runs independent clustering steps, each job consists of
+    an index into features and a name.
+    With n_workers > 1, the steps run in threads (each one
+    waits for its own SPC process), plots are made afterwards
+    because pyplot is not thread-safe.
+    Returns the results in the order of jobs
+    """
+    if (n_workers <= 1) or (len(jobs) < 2):
+        return [cluster_step(features[idx], folder, sub_name, overwrite)
+                for idx, sub_name in jobs]
+
+    def one_job(job):
+        """
+        thread helper
+        """
+        idx, sub_name = job
+        return features_to_index(features[idx], folder, sub_name, overwrite)
+
+    pool = ThreadPool(min(n_workers, len(jobs)))
+    results = pool.map(one_job, jobs)
+    pool.close()
+    pool.join()
+
+    ret = []
+    for (_, sub_name), (res_idx, tree, used_points) in zip(jobs, results):
+        finish_step(res_idx, tree, used_points, folder, sub_name)
+        ret.append(res_idx)
 
-def iterative_sorter(features, spikes, n_iterations, name, overwrite=True):
+    return ret
+
+
+def iterative_sorter(features, spikes, n_iterations, name, overwrite=True,
+                     recluster_workers=RECLUSTER_WORKERS):
     """
     name is used to generate temporary filenames
+    recluster_workers is the number of reclustering steps
+    that may run concurrently
     """
     idx = np.zeros(features.shape[0], np.uint16)
     match_idx = np.zeros(features.shape[0], bool)
@@ -129,6 +181,7 @@ def iterative_sorter(features, spikes, n_iterations, name, overwrite=True):
         # (to reduce under-clustering)
         if options['ReclusterClusters']:
             clids = np.unique(res_idx[clustered_idx])
+            jobs = []
 
             for clid in clids:
                 recluster_idx = idx == clid
@@ -146,10 +199,16 @@ def iterative_sorter(features, spikes, n_iterations, name, overwrite=True):
                               .format(clid, cluster_size))
 
                 sub_sub_name = '{}_{:02d}'.format(sub_name, clid)
+                jobs.append((recluster_idx, sub_sub_name))
 
-                recluster_res_idx = cluster_step(features[recluster_idx],
-                                                 name, sub_sub_name, overwrite)
+            # the reclustered spikes are disjoint, and new cluster
+            # numbers are always bigger than the clids above,
+            # so results can be computed concurrently and
+            # relabeled afterwards in order of clid
+            results = recluster_steps(features, name, jobs, overwrite,
+                                      recluster_workers)
 
+            for (recluster_idx, _), recluster_res_idx in zip(jobs, results):
                 # make sure to increase the cluster numbers enough
                 biggest_clid = idx.max()
                 recluster_res_idx[recluster_res_idx != 0] += biggest_clid
@@ -161,22 +220,67 @@ def iterative_sorter(features, spikes, n_iterations, name, overwrite=True):
     return idx, match_idx
 
 
-def sort_spikes(spikes, folder, overwrite=False, sign='pos'):
+def coreset_index(n_spikes, size, seed=CORESET_SEED):
+    """
+    stratified subsample: one random spike from each of size
+    consecutive blocks of equal length. Spikes are ordered in time,
+    so the subsample covers the session uniformly in time
+    """
+    edges = np.linspace(0, n_spikes, size + 1).astype(int)
+    rand = np.random.RandomState(seed)
+    offsets = (rand.random_sample(size) * np.diff(edges)).astype(int)
+    return edges[:-1] + offsets
+
+
+def sort_spikes(spikes, folder, overwrite=False, sign='pos',
+                recluster_workers=RECLUSTER_WORKERS, coreset_size=None,
+                features=None):
     """
     function organizes code
+    coreset_size: if smaller than the number of spikes, only a
+    time-uniform subsample of this size is clustered, the remaining
+    spikes are assigned by template matching
+    features: features of spikes (e.g. stored in the data file),
+    computed if not given
     """
     n_iterations = options['RecursiveDepth']
     if options['Debug']:
         print('Recursive depth is {}.'.format(n_iterations))
 
-    # it is suboptimal that we calculate the features
-    # even when reading clusters from disk
-    all_features = wavelet_features(spikes)
+    n_spikes = spikes.shape[0]
+
+    if (coreset_size is None) or (coreset_size >= n_spikes):
+        # features are calculated even when reading clusters
+        # from disk, unless they are stored in the data file
+        all_features = wavelet_features(spikes) if features is None\
+            else features
+
+        # sorting includes template match
+        sorted_idx, match_idx = iterative_sorter(all_features, spikes,
+                                                 n_iterations, folder,
+                                                 overwrite=overwrite,
+                                                 recluster_workers=recluster_workers)
+    else:
+        core_idx = coreset_index(n_spikes, coreset_size)
+        if options['Debug']:
+            print('Clustering coreset of {} out of {} spikes'.
+                  format(coreset_size, n_spikes))
+
+        core_spikes = spikes[core_idx]
+        core_features = wavelet_features(core_spikes) if features is None\
+            else features[core_idx]
+        core_sorted, core_match = iterative_sorter(core_features, core_spikes,
+                                                   n_iterations, folder,
+                                                   overwrite=overwrite,
+                                                   recluster_workers=recluster_workers)
+
+        sorted_idx = np.zeros(n_spikes, core_sorted.dtype)
+        match_idx = np.zeros(n_spikes, bool)
+        sorted_idx[core_idx] = core_sorted
+        match_idx[core_idx] = core_match
 
-    # sorting includes template match
-    sorted_idx, match_idx = iterative_sorter(all_features, spikes,
-                                             n_iterations, folder,
-                                             overwrite=overwrite)
+        # all spikes outside the coreset in one pass
+        template_match(spikes, sorted_idx, match_idx, CORESET_MATCH_FACTOR)
 
     # identify artifact clusters
     class_ids = np.unique(sorted_idx)
@@ -190,17 +294,31 @@ def sort_spikes(spikes, folder, overwrite=False, sign='pos'):
     return sorted_idx, match_idx, artifact_ids
 
 
-def main(data_fname, session_fname, sign, overwrite=False):
+def main(data_fname, session_fname, sign, overwrite=False,
+         recluster_workers=RECLUSTER_WORKERS, coreset_size=None):
     """
     sort spikes from given session
+    coreset_size overrides the value stored by css-prepare-sorting
     """
     sort_man = SortingManager(data_fname)
     session = SessionManager(session_fname)
     idx = session.index
+
+    if coreset_size is None:
+        try:
+            coreset_size = session.h5file.get_node_attr('/', 'coreset_size')
+        except AttributeError:
+            pass
+
     spikes = sort_man.get_data_by_name_and_index('spikes', idx, sign)
+    features = stored_features(sort_man.datamanager, idx, sign)
+    if options['Debug'] and features is not None:
+        print('Using stored features')
     sort_idx, match_idx, artifact_ids =\
         sort_spikes(spikes, session.session_dir,
-                    overwrite=overwrite, sign=sign)
+                    overwrite=overwrite, sign=sign,
+                    recluster_workers=recluster_workers,
+                    coreset_size=coreset_size, features=features)
 
     all_ids = np.unique(sort_idx)
 
@@ -217,11 +335,12 @@ def main(data_fname, session_fname, sign, overwrite=False):
     session.h5file.close()
 
 
-def sort_helper(args):
+def sort_helper(args, recluster_workers=RECLUSTER_WORKERS, coreset_size=None):
     """
     usual multiprocessing helper, used to un
     """
-    main(args[0], args[2], args[1], options['overwrite'])
+    main(args[0], args[2], args[1], options['overwrite'], recluster_workers,
+         coreset_size)
 
 
 def write_options(fname='css-cluster-log.txt'):
@@ -270,7 +389,7 @@ def argument_parser():
     standard argument parsing
     """
     from argparse import ArgumentParser, FileType, ArgumentError
-    from multiprocessing import Pool, cpu_count
+    from multiprocessing import cpu_count
     parser = ArgumentParser('css-cluster',
                             description='Combinato Spike Sorter. This is the'
                                         ' main clustering executable. Specify'
@@ -282,6 +401,19 @@ def argument_parser():
     parser.add_argument('--sessions', nargs='+')
 
     parser.add_argument('--single', default=False, action='store_true')
+    parser.add_argument('--memory-budget', type=float,
+                        help='memory available to all workers (GB)')
+    parser.add_argument('--recluster-workers', type=int,
+                        default=RECLUSTER_WORKERS,
+                        help='number of reclustering steps that run '
+                             'concurrently in each job (cores per job)')
+    parser.add_argument('--coreset-size', type=int,
+                        help='cluster only this many spikes of each '
+                             'session, assign the rest by template '
+                             'matching (overrides css-prepare-sorting). '
+                             'Most spikes stay unassigned in the sessions '
+                             'and are assigned by the match across '
+                             'sessions in css-combine')
 
     # possibilities:
     # 1) jobs is supplied, and neither datafile nor session
@@ -289,6 +421,9 @@ def argument_parser():
 
     args = parser.parse_args()
 
+    if (args.coreset_size is not None) and (args.coreset_size <= 0):
+        parser.error('--coreset-size must be greater than 0')
+
     if args.jobs is None:
         if None in (args.datafile, args.sessions):
             raise ArgumentError(args.jobs,
@@ -298,23 +433,30 @@ def argument_parser():
             joblist = []
             for session in args.sessions:
                 sign = 'neg' if 'neg' in session else 'pos'
-                joblist.append([args.datafile[0], sign, session])
+                joblist.append((args.datafile[0], sign, session))
 
     else:
         jobdata = args.jobs.read().splitlines()
         joblist = tuple((tuple(line.split()) for line in jobdata))
         test_joblist(joblist)
 
-    n_cores = 1 if args.single else cpu_count() + 1
+    recluster_workers = max(1, args.recluster_workers)
+    # each job may use recluster_workers cores
+    n_cores = 1 if args.single else\
+        max(1, (cpu_count() + 1) // recluster_workers)
 
-    print('Starting {} jobs with {} workers'.
-          format(len(joblist), n_cores))
+    print('Starting {} jobs with up to {} workers, {} reclustering steps '
+          'per job'.format(len(joblist), n_cores, recluster_workers))
 
     write_options()
 
-    if n_cores == 1:
-        [sort_helper(job) for job in joblist]
+    helper = partial(sort_helper, recluster_workers=recluster_workers,
+                     coreset_size=args.coreset_size)
 
+    if args.memory_budget is None:
+        budget = None
     else:
-        pool = Pool(n_cores)
-        pool.map(sort_helper, joblist)
+        budget = args.memory_budget * 1024**3
+
+    # largest jobs first, progress is printed
+    run_jobs(helper, joblist, n_cores, budget)
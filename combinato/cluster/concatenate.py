@@ -7,20 +7,25 @@ for final grouping
 """
 from __future__ import print_function, division, absolute_import
 import os
+import hashlib
 import numpy as np
 #   pylint: disable=E1101
 import tables
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool, cpu_count, current_process
 
 import matplotlib.pyplot as mpl
 
 from .. import SessionManager, SortingManager, options, SPIKE_MATCHED_2,\
-    CLID_UNMATCHED, SPIKE_MATCHED, SPIKE_CLUST
+    CLID_UNMATCHED, SPIKE_MATCHED, SPIKE_CLUST, GROUP_ART, GROUP_NOCLASS,\
+    TYPE_ART, TYPE_MU
 
-from .dist import distances_euclidean, get_means
+from .dist import distance_chunk_size, get_means, distances_groups,\
+    second_match, N_THREADS
+from .grouped_stats import group_index, grouped_stats
 from .create_groups import main as create_groups_main
 from .artifacts import find_artifacts
 from .cluster import test_joblist
+from ..plot.density import spike_density
 
 COL_CLASS = 0
 COL_GROUP = 1
@@ -33,6 +38,17 @@ MATCH_COLOR_2 = '#ff7700'
 # status printout
 MSG = True
 
+# class plots: 'lines' or 'density'
+PLOT_MODE = 'lines'
+# density mode: amplitude bins and number of example spikes per type
+DENSITY_BINS = 100
+MAX_TRACES = 20
+DENSITY_CMAP = 'Greys'
+# digests of plotted classes, to skip unchanged classes
+PLOT_MANIFEST = 'class_plots.txt'
+# job files of appended sessions are named like sort_pos_joh_append.txt
+APPEND_SUFFIX = '_append'
+
 plotdata = ((SPIKE_MATCHED_2, MATCH_COLOR_2),
             (SPIKE_MATCHED, MATCH_COLOR),
             (SPIKE_CLUST, ORIG_COLOR))
@@ -142,10 +158,13 @@ def collect_sorting(fname, signs, sessions, outfname):
     return sort_man
 
 
-def total_match(fid, all_spikes):
+def total_match(fid, all_spikes, n_threads=N_THREADS):
     """
     read classes from h5file and match unmatched spikes
     this repeats the function from cluster/dist.py, sorry for the bad style
+    all_spikes can be an array or an IndexedNode, it is accessed
+    in chunks only. Results are written to fid at once
+    n_threads: threads for the distance calculation
     """
     classes = fid.root.classes[:]
 
@@ -156,51 +175,48 @@ def total_match(fid, all_spikes):
     if not len(ids):
         return fid.root.classes[:], fid.root.matches[:]
     unmatched_idx = (classes == CLID_UNMATCHED).nonzero()[0]
-    # unmatched_spikes = all_spikes[unmatched_idx]
+    matches = fid.root.matches[:]
+    distance = fid.root.distance[:]
 
     # JN 2016-09-08: For spike counts greater 10^6, this becomes a memory problem
-    # the procedure should be done in batches of 50,000 spikes
-    blocksize =  50*1000
+    # the procedure is done in batches, one chunk per distance thread
+    blocksize = n_threads * distance_chunk_size(all_spikes.shape[1],
+                                                mean_array.shape[0])
     n_unmatched = unmatched_idx.shape[0]
-    starts = np.arange(0, n_unmatched, blocksize)
-    if not len(starts):
-        starts = np.array([0])
-        stops = np.array([n_unmatched])
-    else: 
-        stops = starts + blocksize
-        stops[-1] = n_unmatched
-
-    for start, stop in zip(starts, stops):
-        this_idx = unmatched_idx[start:stop] 
-        print('Calculating match for {} spikes'.
-            format(all_spikes[this_idx].shape[0]))
-        all_dists = distances_euclidean(all_spikes[this_idx], mean_array)
-        print('all_dists: {}'.format(all_dists.shape))
-
-        all_dists[all_dists > options['SecondMatchFactor'] * stds] = np.inf
-        minimizers_idx = all_dists.argmin(1)
-        minimizers = ids[minimizers_idx]
-
-        minima = all_dists.min(1)
-        minimizers[minima >= options['SecondMatchMaxDist'] * all_spikes.shape[1]] = 0
-
-        fid.root.classes[this_idx] = minimizers
-        fid.root.matches[this_idx] = SPIKE_MATCHED_2
-        fid.root.distance[this_idx] = minima
 
+    for start in range(0, n_unmatched, blocksize):
+        this_idx = unmatched_idx[start:start + blocksize]
+        print('Calculating match for {} spikes'.format(this_idx.shape[0]))
+        minimizers, minima = second_match(all_spikes[this_idx],
+                                          ids, mean_array, stds, n_threads)
+
+        classes[this_idx] = minimizers
+        matches[this_idx] = SPIKE_MATCHED_2
+        distance[this_idx] = minima
+
+    # one contiguous write instead of scattered writes
+    fid.root.classes[:] = classes
+    fid.root.matches[:] = matches
+    fid.root.distance[:] = distance
     fid.flush()
-    return fid.root.classes[:], fid.root.matches[:]
+    return classes, matches
 
 
-def plot_all_classes(classes, matches, all_spikes, plot_dirname):
+def plot_all_classes(classes, matches, all_spikes, plot_dirname,
+                     mode=PLOT_MODE, n_workers=1, index=None):
     """
     plot classes
+    mode: 'lines' plots every spike, 'density' plots a density image
+    with a few example spikes
+    n_workers: render plots in a process pool (density mode)
+    index: spike index of all_spikes, used to skip unchanged classes
     """
 
     if not os.path.isdir(plot_dirname):
         os.mkdir(plot_dirname)
 
-    clids = np.unique(classes)
+    # index of all classes, from one sort
+    clids, class_index = group_index(classes)
     fig = mpl.figure(figsize=options['figsize'])
     fig.add_axes([0, 0, 1, 1])
     xax = np.arange(all_spikes.shape[1])
@@ -217,16 +233,115 @@ def plot_all_classes(classes, matches, all_spikes, plot_dirname):
         else:
             ylim = options['ylim']
 
-    for clnum, clid in enumerate(clids):
-        cl_idx = classes == clid
+    old_manifest = read_plot_manifest(plot_dirname)
+    manifest = {}
+    jobs = []
+
+    for clnum, (clid, cl_idx) in enumerate(zip(clids, class_index)):
         outname = os.path.join(plot_dirname, 'class_{:03d}.png'.format(clid))
+        digest = class_digest(cl_idx if index is None else index[cl_idx],
+                              matches[cl_idx], mode, ylim)
+        manifest[clid] = digest
+        if (old_manifest.get(clid) == digest) and os.path.exists(outname):
+            print('Class {} unchanged, not plotting'.format(clid))
+            continue
         print('Plotting {}/{}, {}, {} spikes'.
-               format(clnum + 1, len(clids), plot_dirname, cl_idx.sum()))
-        plot_class(fig, xax, xlim, ylim,
-                   all_spikes[cl_idx], matches[cl_idx], outname)
+               format(clnum + 1, len(clids), plot_dirname, cl_idx.shape[0]))
+        if mode == 'density':
+            jobs.append((density_plot_data(all_spikes[cl_idx],
+                                           matches[cl_idx], ylim),
+                         xlim, ylim, outname))
+        else:
+            plot_class(fig, xax, xlim, ylim,
+                       all_spikes[cl_idx], matches[cl_idx], outname)
 
     mpl.close(fig)
 
+    if len(jobs):
+        # daemonic pool workers (one per channel) cannot start a pool
+        if (n_workers > 1) and not current_process().daemon:
+            pool = Pool(n_workers)
+            pool.map(render_density_job, jobs)
+            pool.close()
+            pool.join()
+        else:
+            for job in jobs:
+                render_density_job(job)
+
+    write_plot_manifest(plot_dirname, manifest)
+
+
+def class_digest(cl_index, types, mode, ylim):
+    """
+    identifies the contents of a class plot
+    """
+    digest = hashlib.md5()
+    digest.update(np.ascontiguousarray(cl_index).tobytes())
+    digest.update(np.ascontiguousarray(types).tobytes())
+    digest.update('{} {:.6f} {:.6f} {} {}'.format(mode, ylim[0], ylim[1],
+                                                  DENSITY_BINS,
+                                                  MAX_TRACES).encode())
+    return digest.hexdigest()
+
+
+def read_plot_manifest(plot_dirname):
+    """
+    returns a dictionary of plotted classes and their digests
+    """
+    ret = {}
+    fname = os.path.join(plot_dirname, PLOT_MANIFEST)
+    if os.path.exists(fname):
+        with open(fname, 'r') as fid:
+            for line in fid:
+                fields = line.split()
+                if len(fields) == 2:
+                    ret[int(fields[0])] = fields[1]
+    return ret
+
+
+def write_plot_manifest(plot_dirname, manifest):
+    """
+    stores digests of plotted classes
+    """
+    fname = os.path.join(plot_dirname, PLOT_MANIFEST)
+    with open(fname, 'w') as fid:
+        for clid in sorted(manifest):
+            fid.write('{} {}\n'.format(clid, manifest[clid]))
+
+
+def density_plot_data(spikes, types, ylim):
+    """
+    everything needed to render a class in density mode:
+    density image, counts and a random subset of spikes per type
+    """
+    edges = np.linspace(ylim[0], ylim[1], DENSITY_BINS + 1)
+    rand = np.random.RandomState(0)
+    traces = []
+    counts = []
+
+    for sp_type, sp_color in plotdata:
+        idx = (types == sp_type).nonzero()[0]
+        counts.append(idx.shape[0])
+        if idx.shape[0] > MAX_TRACES:
+            idx = np.sort(rand.choice(idx, MAX_TRACES, replace=False))
+        traces.append(spikes[idx])
+
+    return {'density': spike_density(spikes, edges),
+            'traces': traces,
+            'counts': counts,
+            'mean': spikes.mean(0)}
+
+
+def render_density_job(args):
+    """
+    multiprocessing helper
+    """
+    data, xlim, ylim, fname = args
+    fig = mpl.figure(figsize=options['figsize'])
+    fig.add_axes([0, 0, 1, 1])
+    plot_class_density(fig, xlim, ylim, data, fname)
+    mpl.close(fig)
+
 
 def plot_class(fig, xax, xlim, ylim, spikes, types, fname):
     """
@@ -257,9 +372,44 @@ def plot_class(fig, xax, xlim, ylim, spikes, types, fname):
     fig.savefig(fname)
 
 
-def main(fname, sessions, label, do_plot=True):
+def plot_class_density(fig, xlim, ylim, data, fname):
+    """
+    plot density image and example spikes according to type
+    """
+    lnw = options['linewidth']
+    xax = np.arange(xlim[0], xlim[1] + 1)
+    axis = fig.get_axes()[0]
+    axis.cla()
+    axis.imshow(np.log1p(data['density']), cmap=DENSITY_CMAP,
+                aspect='auto', origin='lower', interpolation='nearest',
+                extent=(xlim[0], xlim[1], ylim[0], ylim[1]))
+    axis.set_xlim(xlim)
+    axis.set_ylim(ylim)
+    axis.set_xticks(np.linspace(xlim[0], xlim[1], 5))
+    axis.set_yticks(np.linspace(ylim[0], ylim[1], 5))
+    axis.grid(True)
+    skip = ylim[1]/8
+    for i, ((_, sp_color), traces, count) in\
+            enumerate(zip(plotdata, data['traces'], data['counts'])):
+        if count:
+            axis.plot(xax, traces.T, sp_color, lw=lnw)
+            axis.text(xax[-2], ylim[1] - skip*i - 10, str(count),
+                      color=sp_color, ha='right', va='top', size=9)
+
+    axis.plot(xax, data['mean'], 'k', lw=1.5*lnw)
+    axis.text(xax[2], ylim[1] - 10, u'{:.0f} µV'.format(ylim[1]),
+              color='k', ha='left', va='top', size=9)
+    fig.savefig(fname)
+
+
+def main(fname, sessions, label, do_plot=True, streaming=False,
+         plot_mode=PLOT_MODE, plot_workers=1, n_threads=N_THREADS):
     """
     usual main function
+    streaming: do not load all spikes into memory,
+    read them in chunks when needed
+    plot_mode, plot_workers: see plot_all_classes
+    n_threads: threads for the distance calculation
     """
     # make the necessary dictionary
     sign = 'neg' if 'neg' in sessions[0] else 'pos'
@@ -290,10 +440,10 @@ def main(fname, sessions, label, do_plot=True):
     fid = tables.open_file(outfname, 'r+')
     fid.set_node_attr('/', 'sign', sign)
     spk_idx = fid.root.index[:]
-    all_spikes = sort_man.get_data_by_name_and_index('spikes', spk_idx, sign)
-    del sort_man
+    all_spikes = sort_man.get_data_by_name_and_index('spikes', spk_idx, sign,
+                                                     lazy=streaming)
 
-    classes, matches = total_match(fid, all_spikes)
+    classes, matches = total_match(fid, all_spikes, n_threads)
 
     # after matching, artifacts might be different!
     if options['RecheckArtifacts']:
@@ -320,13 +470,232 @@ def main(fname, sessions, label, do_plot=True):
         # print('New artifacts: {}'.format(fid.root.artifacts))
 
     if do_plot:
-        plot_all_classes(classes, matches, all_spikes, sorting_dir)
+        plot_all_classes(classes, matches, all_spikes, sorting_dir,
+                         plot_mode, plot_workers, spk_idx)
         logfid.write('Plotted classes in {}\n'.format(sorting_dir))
 
     print(fid.filename, fid.root.artifacts[:])
 
     fid.close()
     logfid.close()
+    del all_spikes, sort_man
+
+    return outfname
+
+
+def class_and_group_means(classes, spikes, groups, types):
+    """
+    means of existing classes (as in get_means) and of groups
+    that are not artifacts or unassigned, in one pass over spikes
+    returns ids, means, stds, gids, group_means
+    """
+    stats = grouped_stats(classes, spikes)
+    if stats.ids is None:
+        empty = np.array([])
+        return empty, empty, empty, empty, empty
+
+    keep = stats.ids != CLID_UNMATCHED
+    ids = stats.ids[keep]
+    means = stats.means[keep]
+    stds = np.sqrt(stats.variances[keep].sum(1))
+    counts = stats.counts[keep]
+
+    art_gids = types[types[:, 1] == TYPE_ART, 0]
+    gids = []
+    group_means = []
+
+    for gid in np.unique(groups[:, 1]):
+        if (gid in (GROUP_ART, GROUP_NOCLASS)) or (gid in art_gids):
+            continue
+        members = np.isin(ids, groups[groups[:, 1] == gid, 0])
+        if not counts[members].sum():
+            continue
+        gids.append(gid)
+        group_means.append((means[members] * counts[members, np.newaxis]).
+                           sum(0) / counts[members].sum())
+
+    return ids, means, stds, np.array(gids), np.array(group_means)
+
+
+def _replace_array(fid, name, data):
+    """
+    arrays cannot grow, so they are written again
+    """
+    fid.remove_node('/', name)
+    fid.create_array('/', name, data)
+
+
+def append_sorting(fname, sessions, label, do_plot=True,
+                   plot_mode=PLOT_MODE, plot_workers=1, n_threads=N_THREADS):
+    """
+    adds sessions of newly recorded spikes to an existing sorting.
+    Unclustered new spikes are matched to all classes, new classes
+    join the closest existing group or form new groups.
+    Existing classes, groups and types, including changes
+    made in the GUI, are kept. Only new spikes are clustered
+    """
+    sign = 'neg' if 'neg' in sessions[0] else 'pos'
+
+    for ses in sessions:
+        if sign not in ses:
+            raise ValueError('Different signs: {}'.format(sessions))
+
+    basedir = os.path.dirname(fname)
+    sorting_dir = os.path.join(basedir, label)
+    outfname = os.path.join(sorting_dir, 'sort_cat.h5')
+
+    if not os.path.exists(outfname):
+        print(outfname + ' does not exist, nothing to append to!')
+        return None
+
+    fid = tables.open_file(outfname, 'r+')
+
+    if 'types' not in fid.root:
+        print(outfname + ' has no groups, run css-combine first!')
+        fid.close()
+        return None
+
+    old_index = fid.root.index[:]
+    old_classes = fid.root.classes[:]
+    groups = fid.root.groups[:]
+    types = fid.root.types[:]
+
+    sort_man = SortingManager(fname)
+    ses_mans = {}
+
+    for ses in sessions:
+        ses_mans[ses] = SessionManager(os.path.join(basedir, ses))
+
+    print('Starting read from {}'.format(fname))
+    new_index, new_info, new_artifacts = read_all_info(ses_mans)
+    for ses, man in ses_mans.items():
+        print('Closed {}'.format(ses))
+        del man
+
+    if new_index[0] <= old_index[-1]:
+        fid.close()
+        raise ValueError('Sessions overlap with the existing sorting')
+
+    # new class ids start above all ids used so far
+    offset = int(max(old_classes.max(), fid.root.artifacts[:, 0].max(),
+                     groups[:, 0].max()))
+    if offset + int(new_info[:, COL_CLASS].max()) > np.iinfo(np.uint16).max:
+        fid.close()
+        raise ValueError('Too many classes, new class ids would exceed {}'.
+                         format(np.iinfo(np.uint16).max))
+    new_classes = new_info[:, COL_CLASS].astype(np.uint16)
+    new_classes[new_classes != CLID_UNMATCHED] += offset
+    new_matches = new_info[:, COL_MATCH_TYPE].astype(np.int8)
+    new_distance = np.zeros(new_index.shape[0], np.float32)
+    new_artifacts = new_artifacts[new_artifacts[:, 0] != CLID_UNMATCHED]
+    new_artifacts[:, 0] += offset
+
+    # existing spikes are only read to compute means
+    old_spikes = sort_man.get_data_by_name_and_index('spikes', old_index,
+                                                     sign, lazy=True)
+    new_spikes = sort_man.get_data_by_name_and_index('spikes', new_index,
+                                                     sign)
+
+    old_ids, old_means, old_stds, gids, group_means =\
+        class_and_group_means(old_classes, old_spikes, groups, types)
+    new_ids, new_means, new_stds = get_means(new_classes, new_spikes)
+
+    ids = np.hstack((old_ids, new_ids)).astype(np.uint16)
+    if len(ids):
+        mean_array = np.vstack([arr for arr in (old_means, new_means)
+                                if len(arr)])
+        stds = np.hstack((old_stds, new_stds))
+
+    unmatched_idx = (new_classes == CLID_UNMATCHED).nonzero()[0]
+    if len(ids) and len(unmatched_idx):
+        print('Matching {} new spikes'.format(unmatched_idx.shape[0]))
+        minimizers, minima = second_match(new_spikes[unmatched_idx],
+                                          ids, mean_array, stds, n_threads)
+        new_classes[unmatched_idx] = minimizers
+        new_matches[unmatched_idx] = SPIKE_MATCHED_2
+        new_distance[unmatched_idx] = minima
+
+    # artifacts of new classes, existing classes are kept as they are
+    new_clids = np.unique(new_classes[new_classes > offset])
+    if options['RecheckArtifacts']:
+        invert = True if sign == 'neg' else False
+        _, art_ids = find_artifacts(new_spikes, new_classes, new_clids,
+                                    invert)
+        art_rows = np.zeros((new_clids.shape[0], 2),
+                            fid.root.artifacts.dtype)
+        art_rows[:, 0] = new_clids
+        art_rows[np.isin(new_clids, art_ids), 1] = 1
+    else:
+        art_rows = new_artifacts[np.isin(new_artifacts[:, 0], new_clids)]
+
+    # new classes join the closest existing group, or form a new one
+    new_groups = np.zeros((new_clids.shape[0], 2), groups.dtype)
+    new_groups[:, 0] = new_clids
+    next_gid = max(groups[:, 1].max(), types[:, 0].max()) + 1
+    new_types = []
+
+    for row, clid in enumerate(new_clids):
+        if art_rows[art_rows[:, 0] == clid, 1].any():
+            new_groups[row, 1] = GROUP_ART
+            continue
+
+        if len(gids):
+            dists = distances_groups(group_means,
+                                     new_means[new_ids == clid][0], sign)
+            closest = np.nanargmin(dists) if not np.isnan(dists).all()\
+                else None
+            if (closest is not None) and\
+                    (dists[closest] <= options['MaxDistMatchGrouping']):
+                new_groups[row, 1] = gids[closest]
+                print('Class {} joins group {}, dist: {:.4f}'.
+                      format(clid, gids[closest], dists[closest]))
+                continue
+
+        new_groups[row, 1] = next_gid
+        new_types.append((next_gid, TYPE_MU))
+        next_gid += 1
+
+    if GROUP_ART in new_groups[:, 1] and GROUP_ART not in types[:, 0]:
+        new_types.append((GROUP_ART, TYPE_ART))
+    new_types = np.array(new_types, types.dtype).reshape(-1, 2)
+
+    print('Appending {} spikes, {} new classes, {} new groups'.
+          format(new_index.shape[0], new_clids.shape[0], len(new_types)))
+
+    classes = np.hstack((old_classes, new_classes))
+    matches = np.hstack((fid.root.matches[:], new_matches))
+    _replace_array(fid, 'index', np.hstack((old_index, new_index)))
+    _replace_array(fid, 'classes', classes)
+    _replace_array(fid, 'matches', matches)
+    _replace_array(fid, 'distance',
+                   np.hstack((fid.root.distance[:], new_distance)))
+    _replace_array(fid, 'artifacts',
+                   np.vstack((fid.root.artifacts[:], art_rows)))
+    if 'artifacts_prematch' in fid.root:
+        _replace_array(fid, 'artifacts_prematch',
+                       np.vstack((fid.root.artifacts_prematch[:],
+                                  new_artifacts)))
+
+    for name, data in (('groups', new_groups), ('types', new_types)):
+        _replace_array(fid, name,
+                       np.vstack((fid.get_node('/', name)[:], data)))
+        orig = name + '_orig'
+        if orig in fid.root:
+            _replace_array(fid, orig,
+                           np.vstack((fid.get_node('/', orig)[:], data)))
+
+    fid.flush()
+
+    if do_plot:
+        spk_idx = fid.root.index[:]
+        all_spikes = sort_man.get_data_by_name_and_index('spikes', spk_idx,
+                                                         sign, lazy=True)
+        plot_all_classes(classes, matches, all_spikes, sorting_dir,
+                         plot_mode, plot_workers, spk_idx)
+        del all_spikes
+
+    fid.close()
+    del old_spikes, new_spikes, sort_man
 
     return outfname
 
@@ -335,12 +704,20 @@ def multi_helper(args):
     """
     standard multiprocessing helper
     """
-    fname, sessions, label, do_groups, do_plot = args
+    fname, sessions, label, do_groups, do_plot, streaming, plot_mode,\
+        plot_workers, append, n_threads = args
+
+    if append:
+        # groups are extended by append_sorting
+        append_sorting(fname, sessions, label, do_plot,
+                       plot_mode, plot_workers, n_threads)
+        return
 
-    outfname = main(fname, sessions, label, do_plot)
+    outfname = main(fname, sessions, label, do_plot, streaming,
+                    plot_mode, plot_workers, n_threads)
     if do_groups:
         if outfname is not None:
-            create_groups_main(fname, outfname)
+            create_groups_main(fname, outfname, lazy=streaming)
 
 
 def parse_args():
@@ -359,11 +736,32 @@ def parse_args():
     parser.add_argument('--no-grouping', default=False, action='store_true')
     parser.add_argument('--single', default=False, action='store_true')
     parser.add_argument('--no-plots', default=False, action='store_true')
+    parser.add_argument('--streaming', default=False, action='store_true',
+                        help='read spikes in chunks instead of loading '
+                             'all spikes of a channel')
+    parser.add_argument('--plot-mode', choices=('lines', 'density'),
+                        default=PLOT_MODE,
+                        help='plot every spike, or a density image '
+                             'with example spikes')
+    parser.add_argument('--plot-workers', type=int, default=1,
+                        help='processes for rendering class plots '
+                             '(density mode, used with --single)')
+    parser.add_argument('--append', default=False, action='store_true',
+                        help='add sessions of new spikes to an existing '
+                             'sorting, keeping its classes and groups')
+    parser.add_argument('--distance-threads', type=int, default=N_THREADS,
+                        help='threads for the distance calculation of the '
+                             'match across sessions (per channel)')
 
     args = parser.parse_args()
     do_groups = not args.no_grouping
     single = args.single
     do_plots = not args.no_plots
+    streaming = args.streaming
+    plot_mode = args.plot_mode
+    plot_workers = args.plot_workers
+    append = args.append
+    n_threads = max(1, args.distance_threads)
 
     if args.jobs is None:
         if None in (args.datafile, args.sessions, args.label):
@@ -371,15 +769,16 @@ def parse_args():
                                 'Specify either jobs or datafile, '
                                 'sessions, and label')
         else:
-            outfname = main(args.datafile[0], args.sessions, args.label[0],
-                            do_plots)
-            if do_groups:
-                if outfname is not None:
-                    create_groups_main(args.datafile[0], outfname)
+            multi_helper((args.datafile[0], args.sessions, args.label[0],
+                          do_groups, do_plots, streaming, plot_mode,
+                          plot_workers, append, n_threads))
 
     else:
         if args.label is None:
             label = args.jobs.name[:-4]
+            # jobs written by css-prepare-sorting --append-to
+            if append and label.endswith(APPEND_SUFFIX):
+                label = label[:-len(APPEND_SUFFIX)]
         else:
             label = args.label[0]
         jobs = tuple((tuple(x.split()) for x in args.jobs.readlines()))
@@ -397,10 +796,14 @@ def parse_args():
 
         if single:
             for fname, sessions in jobdict.items():
-                multi_helper((fname, sessions, label, do_groups, do_plots))
+                multi_helper((fname, sessions, label, do_groups, do_plots,
+                              streaming, plot_mode, plot_workers, append,
+                              n_threads))
         else:
             pool = Pool(cpu_count())
             print('Starting {} workers to concatenate'.format(cpu_count()))
             pool.map(multi_helper, [(fname, sessions, label,
-                                     do_groups, do_plots)
+                                     do_groups, do_plots, streaming,
+                                     plot_mode, plot_workers, append,
+                                     n_threads)
                                     for fname, sessions in jobdict.items()])
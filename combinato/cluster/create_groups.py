@@ -6,11 +6,16 @@ read a total sorting file and group the classes
 """
 from __future__ import absolute_import, print_function, division
 
+import heapq
 import tables
 import numpy as np
 from .. import SortingManager, options, CLID_UNMATCHED, GROUP_ART, GROUP_NOCLASS,\
     TYPE_ART, TYPE_NO, TYPE_MU
-from .dist import distance_groups
+from .dist import distances_groups
+from .grouped_stats import grouped_stats
+
+# rows of the initial distance matrix computed at once
+DIST_BLOCK_ROWS = 64
 
 
 def create_groups(spikes, classes, clids, sign):
@@ -22,42 +27,70 @@ def create_groups(spikes, classes, clids, sign):
     n_groups_in = len(clids) + 1
     means = np.empty((n_groups_in, spikes.shape[1]))
     nspks = np.empty(n_groups_in, int)
-    dists = np.zeros((n_groups_in, n_groups_in))
-    # initialize to inf
-    dists[:, :] = np.inf
     count = 1
-    
-    for clid in clids:
+
+    # means of all classes in one pass
+    stats = grouped_stats(classes, spikes)
+    pos, found = stats.positions(clids)
+
+    for clid, row, is_found in zip(clids, pos, found):
         if clid == CLID_UNMATCHED:
             continue
         count += 1
         groups[count] = [clid]
-        idx = classes == clid
-        nspks[count] = idx.sum()
-        means[count, :] = spikes[idx].mean(0)
-
-    # do an initial upper triangular matrix of dists
-
-    for i in range(n_groups_in):
-        if i not in groups:
+        if is_found:
+            nspks[count] = stats.counts[row]
+            means[count, :] = stats.means[row]
+        else:
+            nspks[count] = 0
+            means[count, :] = np.nan
+
+    # initial upper triangular matrix of dists, computed in blocks of rows
+    dists = np.zeros((n_groups_in, n_groups_in))
+    dists[:, :] = np.inf
+    alive = np.array(sorted(groups.keys()), int)
+
+    for start in range(0, alive.shape[0], DIST_BLOCK_ROWS):
+        rows = alive[start:start + DIST_BLOCK_ROWS]
+        block = distances_groups(means[np.newaxis, alive, :],
+                                 means[rows, np.newaxis, :], sign)
+        block[alive[np.newaxis, :] <= rows[:, np.newaxis]] = np.inf
+        dists[rows[:, np.newaxis], alive[np.newaxis, :]] = block
+
+    # priority queue of candidate merges. Entries are ordered as in
+    # dists.argmin(): nan first, then by distance, then by position.
+    # Outdated entries are skipped when they are popped
+    def key(dist, i, j):
+        """
+        heap entry
+        """
+        if np.isnan(dist):
+            return (0, 0., i, j)
+        return (1, dist, i, j)
+
+    heap = [key(dists[i, j], i, j) for i, j in
+            zip(*np.nonzero(~np.isinf(dists)))]
+    heapq.heapify(heap)
+
+    while len(heap):
+        is_num, minimum, gr1, gr2 = heapq.heappop(heap)
+        if (gr1 not in groups) or (gr2 not in groups):
             continue
-        for j in range(i + 1, n_groups_in):
-            if j not in groups:
+        current = dists[gr1, gr2]
+        if is_num:
+            if current != minimum:
                 continue
-            dists[i, j] = distance_groups(means[i, :], means[j, :], sign) 
-
-    # iteratively merge groups and update dists
-    minimum = -1
-    while True:
-        this_argmin = dists.argmin()
-        gr1, gr2 = np.unravel_index(this_argmin, (n_groups_in, n_groups_in))
-        minimum = dists[gr1, gr2]
+        elif not np.isnan(current):
+            continue
+        else:
+            minimum = current
+
         if minimum > crit:
             break
         print('Merging {} and {}, dist: {:.4f}'.format(gr1, gr2, minimum))
         # merge groups 1 and 2 now
         groups[gr1] += groups[gr2]
-        del groups[gr2] 
+        del groups[gr2]
         # update nspks
         nspk1 = nspks[gr1]
         nspk2 = nspks[gr2]
@@ -66,19 +99,30 @@ def create_groups(spikes, classes, clids, sign):
         means[gr1, :] = (means[gr1, :] * nspk1 + means[gr2, :] * nspk2) / (nspk1 + nspk2)
         # update dists: everything containing gr2 is inf now
         # everything containing gr1 has to be redone
+        # (as before, groups between gr1 and gr2 keep their distance)
         dists[gr2, :] = np.inf
         dists[:, gr2] = np.inf
-        for i in groups.keys():
-            if i < gr1:
-                dists[i, gr1] = distance_groups(means[i], means[gr1], sign)
-            elif i > gr2:
-                dists[gr1, i] = distance_groups(means[i], means[gr1], sign)
-    return groups 
+        others = np.array(sorted(groups.keys()), int)
+        others = others[(others < gr1) | (others > gr2)]
+        if not others.shape[0]:
+            continue
+        new_dists = distances_groups(means[others], means[gr1], sign)
+        for other, dist in zip(others, new_dists):
+            if other < gr1:
+                dists[other, gr1] = dist
+                heapq.heappush(heap, key(dist, other, gr1))
+            else:
+                dists[gr1, other] = dist
+                heapq.heappush(heap, key(dist, gr1, other))
+
+    return groups
 
 
-def main(datafname, sorting_fname, read_only=False):
+def main(datafname, sorting_fname, read_only=False, lazy=False):
     """
     main function
+    lazy: do not load all spikes into memory,
+    class means are computed chunk by chunk
     """
     if read_only:
         mode = 'r'
@@ -90,9 +134,12 @@ def main(datafname, sorting_fname, read_only=False):
     sign = sort_fid.get_node_attr('/', 'sign')
 
     idx = sort_fid.root.index[:]
-    spikes = man.get_data_by_name_and_index('spikes', idx, sign)
-    del man
-    print('Read {} spikes'.format(spikes.shape[0]))
+    spikes = man.get_data_by_name_and_index('spikes', idx, sign, lazy=lazy)
+    if lazy:
+        print('Reading {} spikes in chunks'.format(spikes.shape[0]))
+    else:
+        del man
+        print('Read {} spikes'.format(spikes.shape[0]))
     classes = sort_fid.root.classes[:]
     artifacts = sort_fid.root.artifacts[:, :]
     group_arr = artifacts.copy().astype(np.int16)
@@ -104,6 +151,7 @@ def main(datafname, sorting_fname, read_only=False):
     print('Classes: {}'.format(clids))
 
     groups = create_groups(spikes, classes, clids, sign)
+    del spikes
     
     for grid, orig_grid in enumerate(sorted(groups.keys())):
         clids = groups[orig_grid]
@@ -6,27 +6,82 @@ between clusters, groups etc
 
 # pylint: disable=E1101
 from __future__ import division, print_function, absolute_import
+from multiprocessing.pool import ThreadPool
 import numpy as np
-# import sys
 from .. import options, CLID_UNMATCHED
+from .grouped_stats import grouped_stats
 
+# distances are calculated in single precision
+DIST_DTYPE = np.float32
+# memory budget for temporary arrays in distances_euclidean (bytes)
+MEMORY_BUDGET = 256 * 1024**2
+# BLAS releases the GIL, so chunks can be processed in threads
+# (default of css-combine --distance-threads)
+N_THREADS = 1
 
-def distances_euclidean(all_spikes, templates):
+
+def distance_chunk_size(n_samples, n_templates, dtype=DIST_DTYPE,
+                        budget=MEMORY_BUDGET):
     """
-    returns the distances for all spikes and all templates
-    might be useful to do this loop in Cython
+    number of spikes that can be processed at once,
+    given a memory budget in bytes
     """
+    itemsize = np.dtype(dtype).itemsize
+    # copy of the spikes, product and output
+    row_bytes = itemsize * (n_samples + 2 * n_templates)
+    return max(1, int(budget // row_bytes))
 
-    ret = np.empty((all_spikes.shape[0], templates.shape[0]))
 
-    print('Calculating distances')
-
-    for i, template in enumerate(templates):
-        # print(i, end=' ')
-        ret[:, i] = np.sqrt(((all_spikes - template)**2).sum(1))
+def distances_euclidean(all_spikes, templates, chunk_size=None,
+                        n_threads=N_THREADS, dtype=DIST_DTYPE):
+    """
+    returns the distances for all spikes and all templates
+    uses |a - b|^2 = |a|^2 - 2ab + |b|^2, so that the
+    main work is one matrix product per chunk of spikes
+    """
+    n_spikes = all_spikes.shape[0]
+    ret = np.empty((n_spikes, templates.shape[0]), dtype)
+
+    if not n_spikes:
+        return ret
+
+    templates = np.asarray(templates, dtype)
+    templates_t = np.ascontiguousarray(templates.T)
+    templates_sq = (templates**2).sum(1)
+
+    if chunk_size is None:
+        chunk_size = distance_chunk_size(all_spikes.shape[1],
+                                         templates.shape[0], dtype)
+
+    if options['Debug']:
+        print('Calculating distances')
+
+    def one_chunk(start):
+        """
+        distances for one chunk of spikes, written to ret
+        """
+        stop = min(start + chunk_size, n_spikes)
+        spikes = np.asarray(all_spikes[start:stop], dtype)
+        out = ret[start:stop]
+        np.dot(spikes, templates_t, out=out)
+        out *= -2
+        out += (spikes**2).sum(1)[:, np.newaxis]
+        out += templates_sq
+        # rounding can lead to small negative numbers
+        np.maximum(out, 0, out=out)
+        np.sqrt(out, out=out)
+
+    starts = range(0, n_spikes, chunk_size)
+
+    if (n_threads > 1) and (len(starts) > 1):
+        pool = ThreadPool(n_threads)
+        pool.map(one_chunk, starts)
+        pool.close()
+        pool.join()
+    else:
+        for start in starts:
+            one_chunk(start)
 
-    # print()
-    # sys.stdout.flush()
     return ret
 
 
@@ -69,6 +124,25 @@ def template_match(spikes, sort_idx, match_idx, factor):
     match_idx[unmatched_idx] = minimizers
 
 
+def second_match(spikes, ids, mean_array, stds, n_threads=N_THREADS):
+    """
+    returns the closest class of each spike (CLID_UNMATCHED if
+    no class is close enough) and the distance to it.
+    This is the rule of the match across sessions (css-combine)
+    n_threads: threads for the distance calculation
+    """
+    all_dists = distances_euclidean(spikes, mean_array, n_threads=n_threads)
+    all_dists[all_dists > options['SecondMatchFactor'] * stds] = np.inf
+    minimizers_idx = all_dists.argmin(1)
+    minimizers = ids[minimizers_idx]
+
+    minima = all_dists.min(1)
+    minimizers[minima >= options['SecondMatchMaxDist'] * spikes.shape[1]] =\
+        CLID_UNMATCHED
+
+    return minimizers, minima
+
+
 def distance_groups(in1, in2, sign='pos'):
     """
     calculates a distance between mean spikes
@@ -91,6 +165,25 @@ def distance_groups(in1, in2, sign='pos'):
 
 
 
+def distances_groups(in1, in2, sign='pos'):
+    """
+    same as distance_groups, for arrays of mean spikes
+    (the last axis contains samples, other axes are broadcast)
+    """
+    dist = in1 - in2
+
+    if sign == 'pos':
+        dist /= np.minimum(in1.max(-1), in2.max(-1))[..., np.newaxis]
+    elif sign == 'neg':
+        dist /= np.maximum(in1.min(-1), in2.min(-1))[..., np.newaxis]
+    else:
+        raise Warning('Undefined sign: {}'.format(sign))
+
+    l2_dist = np.sqrt((dist**2).sum(-1))
+    linf = np.abs(dist).max(-1)
+    return (l2_dist + 7 * linf)/2
+
+
 def get_means(classes, all_spikes):
     """
     save means for all classes
@@ -98,27 +191,19 @@ def get_means(classes, all_spikes):
     # small check:
     assert classes.shape[0] == all_spikes.shape[0]
 
-    cl_ids = np.unique(classes)
-    ids = []
-    means = []
-    stds = []
-
-    for clid in cl_ids:
-        if clid == CLID_UNMATCHED:
-            continue
-        meandata = all_spikes[classes == clid]
-        if meandata.shape[0]:
-            ids.append(clid)
-            means.append(meandata.mean(0))
-            stds.append(np.sqrt(meandata.var(0).sum()))
-            if options['Debug']:
-                print('class {} has stdval: {:.3f}'.format(clid, stds[-1]))
-
-    if not len(means):
+    stats = grouped_stats(classes, all_spikes)
+    keep = stats.ids != CLID_UNMATCHED if stats.ids is not None else None
+
+    if (keep is None) or (not keep.any()):
         empty = np.array([])
         return empty, empty, empty
 
-    mean_array = np.vstack(means)
-    id_array = np.array(ids)
-    std_array = np.array(stds)
+    id_array = stats.ids[keep]
+    mean_array = stats.means[keep]
+    std_array = np.sqrt(stats.variances[keep].sum(1))
+
+    if options['Debug']:
+        for clid, stdval in zip(id_array, std_array):
+            print('class {} has stdval: {:.3f}'.format(clid, stdval))
+
     return id_array, mean_array, std_array
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+per-class statistics of spikes (counts, means, variances),
+computed in one pass over the data instead of one pass per class
+"""
+
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+# number of spikes read and sorted at once
+CHUNK_SIZE = 100 * 1000
+
+
+def group_index(labels):
+    """
+    returns the unique labels and, for each label,
+    the (sorted) index of its members
+    """
+    order = np.argsort(labels, kind='mergesort')
+    ids, starts = np.unique(labels[order], return_index=True)
+    return ids, np.split(order, starts[1:])
+
+
+class GroupedStats(object):
+    """
+    accumulates counts, means and variances per class.
+    update() can be called repeatedly with chunks of data
+    """
+    def __init__(self, n_samples):
+        self.ids = None
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.means = np.zeros((0, n_samples))
+        self._m2 = np.zeros((0, n_samples))
+
+    def update(self, labels, data):
+        """
+        add a chunk of data, labels contains one class id per row
+        """
+        if not labels.shape[0]:
+            return
+
+        order = np.argsort(labels, kind='mergesort')
+        ids, starts, counts = np.unique(labels[order], return_index=True,
+                                        return_counts=True)
+
+        sorted_data = np.asarray(data[order], dtype=np.float64)
+        means = np.add.reduceat(sorted_data, starts, axis=0)
+        means /= counts[:, np.newaxis]
+        sorted_data -= np.repeat(means, counts, axis=0)
+        m2 = np.add.reduceat(sorted_data**2, starts, axis=0)
+
+        self._merge(ids, counts, means, m2)
+
+    def _merge(self, ids, counts, means, m2):
+        """
+        combine stored and new statistics (Chan et al.)
+        """
+        if self.ids is None:
+            self.ids = ids
+            self.counts = counts.astype(np.int64)
+            self.means = means
+            self._m2 = m2
+            return
+
+        all_ids = np.union1d(self.ids, ids)
+        if all_ids.shape[0] > self.ids.shape[0]:
+            old_pos = np.searchsorted(all_ids, self.ids)
+            new_counts = np.zeros(all_ids.shape[0], np.int64)
+            new_means = np.zeros((all_ids.shape[0], self.means.shape[1]))
+            new_m2 = np.zeros_like(new_means)
+            new_counts[old_pos] = self.counts
+            new_means[old_pos] = self.means
+            new_m2[old_pos] = self._m2
+            self.ids = all_ids
+            self.counts = new_counts
+            self.means = new_means
+            self._m2 = new_m2
+
+        pos = np.searchsorted(self.ids, ids)
+        n_a = self.counts[pos].astype(np.float64)
+        n_b = counts.astype(np.float64)
+        n_ab = n_a + n_b
+        delta = means - self.means[pos]
+        self.means[pos] += delta * (n_b/n_ab)[:, np.newaxis]
+        self._m2[pos] += m2 + delta**2 * (n_a*n_b/n_ab)[:, np.newaxis]
+        self.counts[pos] += counts
+
+    @property
+    def variances(self):
+        """
+        per-class variance of each sample (as in np.var)
+        """
+        return self._m2/self.counts[:, np.newaxis]
+
+    def positions(self, ids):
+        """
+        returns the rows that belong to ids, and
+        a boolean index of the ids that were found
+        """
+        if self.ids is None:
+            return (np.zeros(len(ids), int), np.zeros(len(ids), bool))
+        pos = np.searchsorted(self.ids, ids)
+        pos[pos == self.ids.shape[0]] = 0
+        found = self.ids[pos] == ids
+        return pos, found
+
+
+def grouped_stats(labels, data, chunk_size=CHUNK_SIZE):
+    """
+    statistics of data grouped by labels,
+    data is read in chunks (can be an h5 node)
+    """
+    stats = GroupedStats(data.shape[1])
+    for start in range(0, labels.shape[0], chunk_size):
+        stop = start + chunk_size
+        stats.update(labels[start:stop], data[start:stop])
+
+    return stats
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+assigns new spikes to the classes of an existing sorting
+while they are recorded, with the rules of the template match
+across sessions (SecondMatchFactor, SecondMatchMaxDist).
+Spikes are classified in steps of at most MAX_BATCH spikes,
+so the time from reading to storing a spike is bounded.
+"""
+from __future__ import print_function, division, absolute_import
+import os
+import time
+import numpy as np
+import tables
+
+from .. import DataManager, GROUP_NOCLASS
+from .dist import get_means, second_match
+
+# spikes classified in one step
+MAX_BATCH = 1000
+# seconds between checks of a growing data file
+POLL_INTERVAL = 1.
+RESULT_FNAME = 'online.h5'
+RESULT_DTYPE = np.dtype([('index', np.int64),
+                         ('time', np.float64),
+                         ('clid', np.uint16),
+                         ('group', np.int16),
+                         ('distance', np.float32),
+                         ('latency', np.float32)])
+
+
+def read_sorting(fname):
+    """
+    sign, index, classes and groups of a sorting file,
+    which is opened read-only (css-gui may have it open)
+    """
+    h5fid = tables.open_file(fname, 'r')
+    sign = h5fid.get_node_attr('/', 'sign')
+    try:
+        sign = str(sign, 'utf-8')
+    except TypeError:
+        pass
+    index = h5fid.root.index[:]
+    classes = h5fid.root.classes[:]
+    groups = h5fid.root.groups[:]
+    h5fid.close()
+    return sign, index, classes, groups
+
+
+class OnlineClassifier(object):
+    """
+    class means of an existing sorting, used to classify new spikes.
+    Groups are read once, later changes in the GUI are not seen
+    """
+    def __init__(self, sorting_fname, data_fname):
+        self.sign, index, classes, groups = read_sorting(sorting_fname)
+
+        self.last_sorted = index[-1]
+
+        data_man = DataManager(data_fname)
+        spikes = data_man.get_data_by_name_and_index('spikes', index,
+                                                     self.sign, lazy=True)
+        self.ids, self.means, self.stds = get_means(classes, spikes)
+        del spikes, data_man
+
+        # group of each class
+        self.group_of = np.zeros(max(classes.max(), groups[:, 0].max()) + 1,
+                                 np.int16)
+        self.group_of[:] = GROUP_NOCLASS
+        self.group_of[groups[:, 0]] = groups[:, 1]
+
+        print('Loaded {} classes from {}'.format(len(self.ids),
+                                                 sorting_fname))
+
+    def classify(self, spikes):
+        """
+        returns class, group, and distance of each spike
+        """
+        n_spk = spikes.shape[0]
+        classes = np.zeros(n_spk, np.uint16)
+        distances = np.zeros(n_spk, np.float32)
+        distances[:] = np.inf
+
+        if len(self.ids):
+            for start in range(0, n_spk, MAX_BATCH):
+                stop = min(start + MAX_BATCH, n_spk)
+                classes[start:stop], distances[start:stop] =\
+                    second_match(spikes[start:stop], self.ids,
+                                 self.means, self.stds)
+
+        return classes, self.group_of[classes], distances
+
+
+class ResultFile(object):
+    """
+    appendable table of classified spikes
+    """
+    def __init__(self, fname):
+        if os.path.exists(fname):
+            self.h5fid = tables.open_file(fname, 'a')
+            self.table = self.h5fid.root.results
+        else:
+            self.h5fid = tables.open_file(fname, 'w')
+            self.table = self.h5fid.create_table('/', 'results',
+                                                 RESULT_DTYPE)
+
+    @property
+    def last_index(self):
+        """
+        index of the last stored spike, -1 if there is none
+        """
+        if not self.table.nrows:
+            return -1
+        return self.table.cols.index[-1]
+
+    def append(self, index, times, classes, groups, distances, latency):
+        """
+        store results of one step
+        """
+        rows = np.zeros(classes.shape[0], RESULT_DTYPE)
+        rows['index'] = index
+        rows['time'] = times
+        rows['clid'] = classes
+        rows['group'] = groups
+        rows['distance'] = distances
+        rows['latency'] = latency
+        self.table.append(rows)
+        self.table.flush()
+
+    def close(self):
+        """
+        close the file
+        """
+        self.h5fid.close()
+
+
+def follow(classifier, data_fname, outfile, start=0,
+           poll_interval=POLL_INTERVAL, max_idle=None):
+    """
+    classifies spikes as they are appended to a data file,
+    continuing after the last spike in outfile.
+    The data file is opened for every check, because it
+    is written by another process
+    max_idle: stop after this many seconds without new spikes
+    """
+    next_idx = max(start, outfile.last_index + 1)
+    idle_since = time.time()
+
+    while True:
+        try:
+            h5fid = tables.open_file(data_fname, 'r')
+        except (IOError, tables.HDF5ExtError) as error:
+            # the writer may be busy, or hold a lock on the file
+            print('Cannot open {}, retrying: {}'.format(data_fname, error))
+            if (max_idle is not None) and\
+                    (time.time() - idle_since > max_idle):
+                break
+            time.sleep(poll_interval)
+            continue
+
+        node = h5fid.get_node('/' + classifier.sign)
+        # spikes and times are appended separately by the writer
+        stop = min(node.spikes.shape[0], node.times.shape[0],
+                   next_idx + MAX_BATCH)
+
+        if stop > next_idx:
+            received = time.time()
+            spikes = node.spikes[next_idx:stop]
+            times = node.times[next_idx:stop]
+            h5fid.close()
+
+            classes, groups, distances = classifier.classify(spikes)
+            latency = time.time() - received
+            outfile.append(np.arange(next_idx, stop), times,
+                           classes, groups, distances, latency)
+            print('Classified spikes {}-{} in {:.3f} s'.
+                  format(next_idx, stop - 1, latency))
+            next_idx = stop
+            idle_since = time.time()
+            continue
+
+        h5fid.close()
+        if (max_idle is not None) and (time.time() - idle_since > max_idle):
+            break
+        time.sleep(poll_interval)
+
+
+def parse_args():
+    """
+    usual argument parsing
+    """
+    from argparse import ArgumentParser
+    parser = ArgumentParser('css-online-classify',
+                            description='Assigns spikes from a growing data '
+                                        'file to the classes of an existing '
+                                        'sorting',
+                            epilog='Johannes Niediek (jonied@posteo.de)')
+    parser.add_argument('--datafile', nargs=1, required=True)
+    parser.add_argument('--label', nargs=1, required=True,
+                        help='sorting to use, e.g. sort_pos_joh')
+    parser.add_argument('--outfile',
+                        help='result table (default: online.h5 in the '
+                             'sorting folder)')
+    parser.add_argument('--start', type=int,
+                        help='first spike to classify (default: the first '
+                             'spike after the sorted spikes)')
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                        help='seconds between checks for new spikes')
+    parser.add_argument('--max-idle', type=float,
+                        help='stop after this many seconds without new '
+                             'spikes')
+
+    args = parser.parse_args()
+    data_fname = args.datafile[0]
+    sorting_dir = os.path.join(os.path.dirname(data_fname), args.label[0])
+    outfname = args.outfile if args.outfile is not None\
+        else os.path.join(sorting_dir, RESULT_FNAME)
+
+    classifier = OnlineClassifier(os.path.join(sorting_dir, 'sort_cat.h5'),
+                                  data_fname)
+    start = classifier.last_sorted + 1 if args.start is None else args.start
+
+    outfile = ResultFile(outfname)
+    try:
+        follow(classifier, data_fname, outfile, start,
+               args.poll_interval, args.max_idle)
+    except KeyboardInterrupt:
+        print('Stopped')
+    finally:
+        outfile.close()
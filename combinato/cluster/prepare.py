@@ -7,7 +7,9 @@ prepare clustering jobs
 from __future__ import print_function, division, absolute_import
 import os
 import numpy as np
+import tables
 from .. import options, DataManager, create_session
+from .wave_features import store_features
 
 DEBUG = options['Debug']
 
@@ -73,19 +75,53 @@ def make_arguments(filename, sign, mode, start=0,
     return ret
 
 
+def first_new_spike(filename, sign, sorting_label):
+    """
+    start index (after artifact exclusion) of the spikes
+    that are not part of the given sorting yet
+    """
+    sort_fname = os.path.join(os.path.dirname(filename), sorting_label,
+                              'sort_cat.h5')
+    h5fid = tables.open_file(sort_fname, 'r')
+    last_sorted = h5fid.root.index[-1]
+    h5fid.close()
+
+    h5manager = DataManager(filename, cache=['artifacts'])
+    non_artifact_idx, _ = h5manager.get_non_artifact_index(sign)
+    return np.searchsorted(non_artifact_idx, last_sorted, 'right')
+
+
 def main(fnames, sign, mode, start, stop, max_nspk_session, label,
-         replace, add_one=False):
+         replace, add_one=False, coreset_size=None, features=False,
+         append_to=None):
     """
     creates clustering directories for given arguments
+    coreset_size: if given, css-cluster clusters only this many
+    spikes of each session and template-matches the rest
+    features: store wavelet features in the data files,
+    so that css-cluster does not recompute them
+    append_to: only prepare spikes that are not part of this
+    sorting (label of css-combine) yet
     """
 
     ret = []
+    attrs = None if coreset_size is None else {'coreset_size': coreset_size}
 
     print('running {} {} {} {} {} {} {} {}'.
           format(fnames, sign, mode, start, stop, max_nspk_session,
                  label, 'replace' if replace else 'no replace'))
 
     for name in fnames:
+        if features:
+            h5manager = DataManager(name, mode='r+')
+            print('Storing features in {}'.format(name))
+            store_features(h5manager, sign)
+            del h5manager
+
+        if append_to is not None:
+            start = first_new_spike(name, sign, append_to)
+            print('Appending spikes from {} to {}'.format(start, append_to))
+
         jobs = make_arguments(name, sign, mode, start, stop,
                               max_nspk_session, add_one)
         if jobs is None:
@@ -95,7 +131,8 @@ def main(fnames, sign, mode, start, stop, max_nspk_session, label,
         for job in jobs:
             if job.shape[0] == 0:
                 continue
-            session_name = create_session(dirname, sign, label, job, replace)
+            session_name = create_session(dirname, sign, label, job, replace,
+                                          attrs)
             ret.append((name, sign, os.path.join(dirname, session_name)))
 
     return ret
@@ -129,6 +166,21 @@ def parse_arguments():
                         help='use negative spikes')
     parser.add_argument('--max-nspk', default=20000, type=int,
                         help='maximal number of spikes per run')
+    parser.add_argument('--coreset-size', type=int,
+                        help='cluster only this many spikes of each '
+                             'session (time-uniform subsample), assign '
+                             'the rest by template matching. Most spikes '
+                             'stay unassigned in the sessions and are '
+                             'assigned by the match across sessions in '
+                             'css-combine')
+    parser.add_argument('--store-features', default=False,
+                        action='store_true',
+                        help='store wavelet features in the data files '
+                             '(computed only once for repeated clustering)')
+    parser.add_argument('--append-to',
+                        help='prepare only spikes that are not part of '
+                             'this sorting yet (e.g. sort_pos_joh), '
+                             'for css-combine --append')
     parser.add_argument('--label', default=getuser()[:3],
                         help='name under which sorting is stored')
     parser.add_argument('--start', nargs=1, type=int,
@@ -138,6 +190,9 @@ def parse_arguments():
 
     args = parser.parse_args()
 
+    if (args.coreset_size is not None) and (args.coreset_size <= 0):
+        parser.error('--coreset-size must be greater than 0')
+
     write_log = True
     sign_set = False
 
@@ -171,6 +226,14 @@ def parse_arguments():
     else:
         mode = 'index'
 
+    if args.append_to is not None:
+        if mode == 'time':
+            parser.print_help()
+            print('Cannot combine --append-to and --times')
+            return
+        # start is found for each file
+        args.start = args.stop = None
+
     if args.datafile:
         fnames = args.datafile
         if mode == 'index':
@@ -202,11 +265,19 @@ def parse_arguments():
 
     for start, stop in start_stop:
         sessions = main(fnames, sign, mode, start, stop, args.max_nspk,
-                        args.label, replace=True, add_one=add_one)
+                        args.label, replace=True, add_one=add_one,
+                        coreset_size=args.coreset_size,
+                        features=args.store_features,
+                        append_to=args.append_to)
 
         if write_log:
             outfname = "sort_{}_{}.txt".format(sign, args.label)
-            with open(outfname, 'a') as outf:
+            log_mode = 'a'
+            if args.append_to is not None:
+                # only the sessions of this run are appended
+                outfname = "{}_append.txt".format(args.append_to)
+                log_mode = 'w'
+            with open(outfname, log_mode) as outf:
                 for name, sign, ses in sessions:
                     outf.write("{} {} {}\n".format(name, sign, ses))
             outf.close()
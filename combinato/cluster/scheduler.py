@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+schedules clustering jobs for css-cluster:
+largest sessions first, one job per task, with
+a memory budget and a live progress report.
+Run times are stored so that later runs can
+use measured instead of estimated costs.
+"""
+
+from __future__ import print_function, division, absolute_import
+import os
+import time
+from multiprocessing import Pool
+
+import tables
+
+TIMING_FNAME = 'css-cluster-timing.txt'
+# fields of the timing file, paths may contain spaces
+TIMING_SEP = '\t'
+# SPC run time grows faster than linear in the number of spikes
+COST_EXPONENT = 1.5
+# rough memory use of one job per spike (spikes, features, copies)
+BYTES_PER_SPIKE = 64 * 4 * 8
+
+
+def session_size(session_dir):
+    """
+    number of spikes in a session, without reading the index
+    """
+    fname = os.path.join(session_dir, 'sorting.h5')
+    h5fid = tables.open_file(fname, 'r')
+    size = h5fid.root.index.shape[0]
+    h5fid.close()
+    return size
+
+
+def read_timing(fname=TIMING_FNAME):
+    """
+    reads run times from earlier runs,
+    returns a dictionary session -> (nspk, seconds)
+    """
+    ret = {}
+    if not os.path.exists(fname):
+        return ret
+
+    with open(fname, 'r') as fid:
+        for line in fid:
+            fields = line.rstrip('\n').split(TIMING_SEP)
+            if len(fields) != 5:
+                continue
+            # the latest entry wins
+            ret[fields[2]] = (int(fields[3]), float(fields[4]))
+
+    return ret
+
+
+def write_timing(job, nspk, seconds, fname=TIMING_FNAME):
+    """
+    appends the run time of one job
+    """
+    with open(fname, 'a') as fid:
+        fields = (job[0], job[1], job[2], nspk, '{:.3f}'.format(seconds))
+        fid.write(TIMING_SEP.join(str(field) for field in fields) + '\n')
+
+
+def estimate_costs(joblist, sizes, timing):
+    """
+    estimated cost of each job: the measured run time if the session
+    was clustered before with the same size, otherwise a power of
+    its size, scaled to seconds by earlier measurements if available
+    """
+    rates = [seconds/nspk**COST_EXPONENT
+             for nspk, seconds in timing.values() if nspk > 0]
+    rate = sorted(rates)[len(rates)//2] if len(rates) else 1
+
+    costs = []
+    for job, size in zip(joblist, sizes):
+        if job[2] in timing and timing[job[2]][0] == size:
+            costs.append(timing[job[2]][1])
+        else:
+            costs.append(rate * size**COST_EXPONENT)
+
+    return costs
+
+
+def n_workers_for_memory(n_cores, sizes, budget):
+    """
+    limits the number of workers so that the biggest
+    jobs fit into budget (bytes) at the same time
+    """
+    if (budget is None) or (not len(sizes)):
+        return n_cores
+
+    job_bytes = max(sizes) * BYTES_PER_SPIKE
+    return max(1, min(n_cores, int(budget // job_bytes)))
+
+
+def _timed_call(args):
+    """
+    multiprocessing helper, runs one job and measures its run time
+    """
+    helper, job, num = args
+    start = time.time()
+    helper(job)
+    return num, time.time() - start
+
+
+def _format_seconds(seconds):
+    """
+    h:mm:ss
+    """
+    seconds = int(round(seconds))
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600,
+                                    (seconds // 60) % 60, seconds % 60)
+
+
+def run_jobs(helper, joblist, n_cores, budget=None,
+             timing_fname=TIMING_FNAME):
+    """
+    runs helper(job) for all jobs, largest first
+    budget: memory budget for all workers together (bytes)
+    """
+    sizes = [session_size(job[2]) for job in joblist]
+    timing = read_timing(timing_fname)
+    costs = estimate_costs(joblist, sizes, timing)
+
+    order = sorted(range(len(joblist)), key=lambda i: costs[i], reverse=True)
+    total_cost = sum(costs)
+    total_spikes = sum(sizes)
+
+    n_workers = n_workers_for_memory(n_cores, sizes, budget)
+    print('Scheduling {} jobs ({} spikes) with {} workers, largest first'.
+          format(len(joblist), total_spikes, n_workers))
+
+    tasks = [(helper, joblist[i], i) for i in order]
+
+    if n_workers == 1:
+        results = (_timed_call(task) for task in tasks)
+    else:
+        pool = Pool(n_workers)
+        results = pool.imap_unordered(_timed_call, tasks, chunksize=1)
+
+    start = time.time()
+    done_cost = 0
+    done_spikes = 0
+
+    for count, (num, seconds) in enumerate(results):
+        nspk = sizes[num]
+        write_timing(joblist[num], nspk, seconds, timing_fname)
+        done_cost += costs[num]
+        done_spikes += nspk
+        elapsed = time.time() - start
+        eta = elapsed * (total_cost - done_cost)/done_cost if done_cost else 0
+        print('Finished {}/{} ({} spikes in {:.1f} s), '
+              '{:.0f} spikes/s, elapsed {}, ETA {}'.
+              format(count + 1, len(joblist), nspk, seconds,
+                     done_spikes/elapsed if elapsed else 0,
+                     _format_seconds(elapsed), _format_seconds(eta)))
+
+    if n_workers > 1:
+        pool.close()
+        pool.join()
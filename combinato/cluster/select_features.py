@@ -6,29 +6,79 @@ import numpy as np
 import scipy.stats as stats
 from .. import options
 
-def select_features(features):
+# use at most this many spikes for scoring (None: use all spikes)
+MAX_SPIKES_SCORING = None
+SUBSAMPLE_SEED = 0
+
+
+def ks_scores(features, feat_down, feat_up):
+    """
+    Kolmogorov-Smirnov test against a normal distribution,
+    for all features at once.
+    Each feature is restricted to values between feat_down and feat_up,
+    then normalized. Returns p-values, 0 for empty features.
+    """
+    num_features = features.shape[1]
+    mask = (features > feat_down) & (features < feat_up)
+    counts = mask.sum(0)
+
+    data = np.where(mask, features, 0).astype(np.float64)
+    means = data.sum(0)/np.maximum(counts, 1)
+    data -= means
+    data[~mask] = 0
+    stds = np.sqrt((data**2).sum(0)/np.maximum(counts, 1))
+
+    # invalid entries are sorted to the end of each column
+    data[~mask] = np.inf
+    data.sort(0)
+
+    scores = np.zeros(num_features)
+    valid = (counts > 0) & (stds > 0)
+    if not valid.any():
+        scores[(counts > 0) & ~valid] = np.nan
+        return scores
+
+    # only rows up to the biggest count contain data
+    max_count = counts.max()
+    data = data[:max_count, valid]
+    data /= stds[valid]
+    cdfvals = stats.norm.cdf(data)
+    n_valid = counts[valid]
+    ranks = np.arange(max_count, dtype=np.float64)[:, np.newaxis]
+    in_range = ranks < n_valid
+
+    d_plus = np.where(in_range, (ranks + 1)/n_valid - cdfvals, -np.inf)
+    d_minus = np.where(in_range, cdfvals - ranks/n_valid, -np.inf)
+    dists = np.maximum(d_plus.max(0), d_minus.max(0))
+
+    scores[valid] = np.clip(stats.kstwo.sf(dists, n_valid), 0, 1)
+    # constant features cannot be normalized
+    scores[(counts > 0) & ~valid] = np.nan
+
+    return scores
+
+
+def select_features(features, max_spikes=MAX_SPIKES_SCORING):
     """
     select the features that go into sorting
+    if max_spikes is given, scores are calculated
+    from a random subsample of that many spikes
     """
     factor = options['feature_factor']
     num_features_out = options['nFeatures']
 
-    num_features = features.shape[1]
+    if (max_spikes is not None) and (features.shape[0] > max_spikes):
+        rand = np.random.RandomState(SUBSAMPLE_SEED)
+        sub_idx = np.sort(rand.choice(features.shape[0], max_spikes,
+                                      replace=False))
+        features = features[sub_idx]
 
     feat_std = factor * features.std(0)
     feat_mean = features.mean(0)
     feat_up = feat_mean + feat_std
     feat_down = feat_mean - feat_std
 
-    scores = np.zeros(num_features)
-
-    for i in range(num_features):
-        idx = (features[:, i] > feat_down[i]) & (features[:, i] < feat_up[i])
-        if idx.any():
-            good_features = features[idx, i]
-            good_features = good_features - good_features.mean()
-            good_features /= good_features.std()
-            scores[i] = stats.kstest(good_features, 'norm')[1]
+    scores = ks_scores(features, feat_down, feat_up)
 
     sorted_scores = np.sort(scores)
     border = sorted_scores[num_features_out]
@@ -8,27 +8,64 @@ from .. import options
 WAVELET = pywt.Wavelet(options['Wavelet'])
 OUT_DTYPE = np.float32
 LEVEL = 4
+# number of spikes transformed in one call,
+# limits the size of temporary coefficient arrays
+CHUNK_SIZE = 50 * 1000
 
-def wavelet_features(data):
+
+def wavelet_features(data, chunk_size=CHUNK_SIZE):
     """
     calculates wavelet transform
+    the transform runs on blocks of spikes (along axis 1),
+    which gives the same coefficients as the transform of single spikes
     """
-    # probably implementing this in cython would
-    # save some computation time
-
-    first_row = pywt.wavedec(data[0, :], WAVELET, level=LEVEL)
-    aligned = np.hstack(first_row)
+    n_spikes = data.shape[0]
+    n_coeffs = sum(len(coeff) for coeff in
+                   pywt.wavedec(np.zeros(data.shape[1], data.dtype),
+                                WAVELET, level=LEVEL))
 
-    output = np.empty((data.shape[0], aligned.shape[0]), dtype=OUT_DTYPE)
-    output[0, :] = aligned
+    output = np.empty((n_spikes, n_coeffs), dtype=OUT_DTYPE)
 
-    for i, row in enumerate(data[1:, :]):
-        features = pywt.wavedec(row, WAVELET, level=LEVEL)
-        output[i + 1, :] = np.hstack(features)
+    for start in range(0, n_spikes, chunk_size):
+        stop = min(start + chunk_size, n_spikes)
+        features = pywt.wavedec(data[start:stop], WAVELET,
+                                level=LEVEL, axis=1)
+        output[start:stop, :] = np.hstack(features)
 
     return output
 
 
+def feature_attrs():
+    """
+    version of the wavelet features, stored with them
+    """
+    return {'wavelet': WAVELET.name, 'level': LEVEL}
+
+
+def store_features(manager, sign):
+    """
+    computes and stores features in a data file,
+    manager is a DataManager opened with mode 'r+'
+    """
+    manager.write_features(sign, wavelet_features, feature_attrs())
+
+
+def stored_features(manager, index, sign):
+    """
+    returns stored features of the spikes in index,
+    or None if there are no features of the current version
+    """
+    attrs = manager.get_features_attrs(sign)
+    if attrs is None:
+        return None
+
+    for key, val in feature_attrs().items():
+        if (key not in attrs) or (attrs[key] != val):
+            return None
+
+    return manager.get_data_by_name_and_index('features', index, sign)
+
+
 # FIXME move tests to separate test directory!
 def testit():
     data = np.ones((3, 64)) 
@@ -11,6 +11,7 @@ from PyQt5.QtCore import (QAbstractListModel, Qt, QModelIndex,
 from PyQt5.QtWidgets import QStyledItemDelegate, QStyle
 from PyQt5.QtGui import QPen
 from .. import options
+from ..plot.density import spike_density
 
 
 class GroupListModel(QAbstractListModel):
@@ -43,7 +44,7 @@ class GroupListModel(QAbstractListModel):
             self.times = []
             self.isidata = []
             return
-        allspikes = np.vstack([c.spikes for c in self.clusters]).T
+        allspikes = np.vstack([c.spikes for c in self.clusters])
         self.meandata = [c.meanspike for c in self.clusters]
 
         max_of_means = np.max(np.abs(self.meandata))
@@ -51,18 +52,16 @@ class GroupListModel(QAbstractListModel):
                                    2*max_of_means,
                                    int(2*max_of_means))
 
-        density = [np.histogram(row, bins=bins_density)[0]
-                   for row in allspikes]
+        # all samples binned at once
+        self.densitydata = spike_density(allspikes, bins_density)
 
         timelist = [c.times for c in self.clusters]
         self.times = np.concatenate(timelist)
         self.times.sort()
         data = np.diff(self.times)
         self.isidata = data[data <= self.upto]
-        maxima = [c.spikes.max(1) for c in self.clusters]
 
-        self.densitydata = np.vstack(density).T
-        self.maximadata = np.concatenate(maxima)
+        self.maximadata = allspikes.max(1)
 
     def addCluster(self, cluster):
         """
@@ -22,7 +22,7 @@ from .backend import Backend
 from .load_joblist import PickJobList, GotoJob
 from .picksession import PickSessionDialog
 from .group_list_model import ClusterDelegate
-from .basics import spikeDist
+from ..cluster.dist import distances_euclidean
 
 import numpy as np
 
@@ -216,15 +216,17 @@ class SpikeSorter(QMainWindow, Ui_MainWindow):
             if name not in ['Unassigned', 'Artifacts']:
                 means[name] = np.array(group.meandata).mean(0)
 
-        dist = np.inf
-        minimizer = None
+        names = [name for name in means if name != groupName]
+        if not len(names):
+            return
 
-        for name, mean in means.items():
-            if name != groupName:
-                d = spikeDist(mean, selectedMean)
-                if d < dist:
-                    dist = d
-                    minimizer = name
+        # same as spikeDist, for all groups at once
+        mean_array = np.vstack([means[name] for name in names])
+        dists = distances_euclidean(selectedMean[np.newaxis, :],
+                                    mean_array)[0]
+        dists /= np.minimum(mean_array.max(1), selectedMean.max())
+        minimizer = names[dists.argmin()]
+        dist = dists.min()
 
         print('Moving to ' + minimizer + ', distance {:2f}'.format(dist))
         self.move(self.backend.sessions.groupsByName[minimizer])
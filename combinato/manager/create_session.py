@@ -16,9 +16,10 @@ def _set_attrs(h5file, attrs):
         h5file.set_node_attr('/', key, val)
 
 
-def create_session(folder, sign, label, index, replace=False):
+def create_session(folder, sign, label, index, replace=False, attrs=None):
     """
     creates a new sorting session
+    attrs: additional attributes of the session (e.g. coreset_size)
     """
 
     session_name = 'sort_{}_{}_{:07d}_{:07d}'.format(sign,
@@ -38,7 +39,9 @@ def create_session(folder, sign, label, index, replace=False):
 
     h5fid = tables.open_file(data_fname, 'w')
     h5fid.create_array('/', 'index', index.astype(np.uint32))
-    attrs = {'ident': session_name}
-    _set_attrs(h5fid, attrs)
+    all_attrs = {'ident': session_name}
+    if attrs is not None:
+        all_attrs.update(attrs)
+    _set_attrs(h5fid, all_attrs)
     h5fid.close()
     return session_name
@@ -26,7 +26,78 @@ DEBUG = False
 NO_EXIST_CHECK = True  # check whether image files exist on disk
 EMPTY = np.array([])
 
-H5Data = namedtuple('H5Data', ['spikes', 'times', 'artifacts'])
+H5Data = namedtuple('H5Data', ['spikes', 'times', 'artifacts', 'features'])
+
+# index reading: gaps up to this many rows are read and discarded
+MAX_READ_GAP = 256
+# read one covering slice if at least this fraction of it is needed
+MIN_COVER_DENSITY = .5
+# ... and if the covering slice is not bigger than this (bytes)
+MAX_COVER_BYTES = 1024**3
+# number of spikes transformed at once when features are stored
+FEATURE_CHUNK_SIZE = 100 * 1000
+
+
+def read_by_index(node, index):
+    """
+    reads node[index] for an arbitrary index array.
+    The sorted index is coalesced into contiguous runs, which are
+    read as slices; dense indices are read as one covering slice.
+    The result is in the order of index
+    """
+    if isinstance(node, np.ndarray) or np.ndim(index) == 0:
+        return node[index]
+
+    index = np.asarray(index)
+    if index.dtype == bool:
+        index = index.nonzero()[0]
+
+    if not index.shape[0]:
+        return np.empty((0, ) + tuple(node.shape[1:]), node.dtype)
+
+    uniq, inverse = np.unique(index, return_inverse=True)
+    first = int(uniq[0])
+    last = int(uniq[-1]) + 1
+    row_bytes = node.dtype.itemsize * int(np.prod(node.shape[1:]))
+
+    if (uniq.shape[0] >= MIN_COVER_DENSITY * (last - first)) and\
+            ((last - first) * row_bytes <= MAX_COVER_BYTES):
+        data = node[first:last][uniq - first]
+
+    else:
+        data = np.empty((uniq.shape[0], ) + tuple(node.shape[1:]),
+                        node.dtype)
+        # a new run starts where the gap is too big
+        breaks = (np.diff(uniq) > MAX_READ_GAP).nonzero()[0] + 1
+        run_starts = np.hstack(([0], breaks))
+        run_stops = np.hstack((breaks, [uniq.shape[0]]))
+
+        for start, stop in zip(run_starts, run_stops):
+            row_start = int(uniq[start])
+            row_stop = int(uniq[stop - 1]) + 1
+            block = node[row_start:row_stop]
+            data[start:stop] = block[uniq[start:stop] - row_start]
+
+    return data[inverse.ravel()]
+
+
+class IndexedNode(object):
+    """
+    behaves like node[index] (read-only), but data is read
+    only when it is accessed, so that data bigger
+    than the memory can be processed in chunks
+    """
+    def __init__(self, node, index):
+        self.node = node
+        self.index = np.asarray(index)
+        self.shape = (self.index.shape[0], ) + tuple(node.shape[1:])
+        self.dtype = node.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return read_by_index(self.node, self.index[key])
 
 
 class DataManager(object):
@@ -81,6 +152,11 @@ class DataManager(object):
                 artifacts = None
                 print('No artifacts defined')
 
+            try:
+                features = self._h5file.get_node('/' + sign, 'features')
+            except tables.NoSuchNodeError:
+                features = None
+
             if 'spikes' in cache:
                 spikes = spikes[:]
             if 'times' in cache:
@@ -91,7 +167,7 @@ class DataManager(object):
 
             assert times.shape[0] == spikes.shape[0]
 
-            self._h5data[sign] = H5Data(spikes, times, artifacts)
+            self._h5data[sign] = H5Data(spikes, times, artifacts, features)
 
     def get_h5data(self, sign='pos'):
         """
@@ -99,25 +175,80 @@ class DataManager(object):
         """
         return self._h5data[sign]
 
-    def get_data_by_name_and_index(self, name, index, sign='pos'):
+    def get_data_by_name_and_index(self, name, index, sign='pos',
+                                   lazy=False):
         """
         read out actual data
+        lazy: return an IndexedNode that reads data on access
         """
         if isinstance(index, str):
             if index == 'all':
                 index = slice(None, None)
 
-        if name == 'spikes':
-            return self._h5data[sign].spikes[index, :]
-        elif name == 'times':
-            return self._h5data[sign].times[index]
-
-        elif name == 'artifacts':
-            return self._h5data[sign].artifacts[index]
+        if name in ('spikes', 'times', 'artifacts', 'features'):
+            node = getattr(self._h5data[sign], name)
+            if node is None:
+                raise KeyError('No {} stored for {} spikes'.
+                               format(name, sign))
+            if lazy:
+                if isinstance(index, slice):
+                    index = np.arange(node.shape[0])[index]
+                return IndexedNode(node, index)
+            if isinstance(index, slice):
+                return node[index]
+            # fancy indexing is slow for long, mostly contiguous indices
+            return read_by_index(node, index)
 
         else:
             raise NotImplementedError('Field name {} not known')
 
+    def get_features_attrs(self, sign='pos'):
+        """
+        returns the attributes (version) of stored features,
+        None if there are no features for all spikes
+        """
+        h5data = self._h5data[sign]
+        if (h5data.features is None) or\
+                (h5data.features.shape[0] != h5data.spikes.shape[0]):
+            return None
+
+        attrs = h5data.features.attrs
+        return dict((key, attrs[key]) for key in attrs._v_attrnamesuser)
+
+    def write_features(self, sign, transform, attrs,
+                       chunk_size=FEATURE_CHUNK_SIZE):
+        """
+        stores transform(spikes) as features. Only spikes that have
+        no features yet are transformed. Features with different attrs
+        are replaced. The file has to be opened with mode 'r+'
+        """
+        h5data = self._h5data[sign]
+        spikes = h5data.spikes
+        features = h5data.features
+
+        if features is not None:
+            for key, val in attrs.items():
+                if (key not in features.attrs) or (features.attrs[key] != val):
+                    features.remove()
+                    features = None
+                    break
+
+        if features is None:
+            n_features = transform(spikes[:1]).shape[1]
+            features = self._h5file.create_earray('/' + sign, 'features',
+                                                  tables.Float32Atom(),
+                                                  (0, n_features),
+                                                  expectedrows=spikes.shape[0])
+            for key, val in attrs.items():
+                features.attrs[key] = val
+
+        for start in range(features.shape[0], spikes.shape[0], chunk_size):
+            stop = min(start + chunk_size, spikes.shape[0])
+            features.append(transform(spikes[start:stop]))
+
+        features.flush()
+        self._h5data[sign] = h5data._replace(features=features)
+
     def get_non_artifact_index(self, sign='pos'):
         """
         return index of non-artifacts
@@ -504,11 +635,13 @@ class SortingManager(object):
 
         return idx, fname
 
-    def get_data_by_name_and_index(self, name, index, sign='pos'):
+    def get_data_by_name_and_index(self, name, index, sign='pos',
+                                   lazy=False):
         """
         given an index, returns data
         """
-        return self.datamanager.get_data_by_name_and_index(name, index, sign)
+        return self.datamanager.get_data_by_name_and_index(name, index, sign,
+                                                           lazy)
 
     def get_h5data(self, sign='pos'):
         """
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+2d density of spikes (amplitude bins x samples),
+all samples are binned at once, chunk by chunk
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+# number of spikes binned at once
+CHUNK_SIZE = 100 * 1000
+
+
+def _density_chunk(spikes, edges):
+    """
+    counts of one chunk, one np.bincount over (bin, sample) pairs
+    """
+    n_bins = len(edges) - 1
+    n_samp = spikes.shape[1]
+
+    bins = np.searchsorted(edges, spikes, side='right') - 1
+    # the last bin includes its right edge, as in np.histogram
+    bins[spikes == edges[-1]] = n_bins - 1
+    valid = (bins >= 0) & (bins < n_bins)
+
+    flat = bins * n_samp + np.arange(n_samp)
+    counts = np.bincount(flat[valid], minlength=n_bins * n_samp)
+
+    return counts.reshape(n_bins, n_samp)
+
+
+class SpikeDensity(object):
+    """
+    accumulates the density of spikes.
+    update() can be called repeatedly with chunks of spikes
+    """
+    def __init__(self, edges, n_samples):
+        self.edges = np.asarray(edges)
+        self.counts = np.zeros((len(self.edges) - 1, n_samples),
+                               dtype=np.int64)
+
+    def update(self, spikes):
+        """
+        add a chunk of spikes
+        """
+        if not spikes.shape[0]:
+            return
+        self.counts += _density_chunk(spikes, self.edges)
+
+
+def spike_density(spikes, edges, chunk_size=CHUNK_SIZE):
+    """
+    returns counts of shape (len(edges) - 1, n_samples),
+    the same as np.histogram(spikes[:, col], edges) for every column.
+    spikes are read in chunks (can be an h5 node)
+    """
+    density = SpikeDensity(edges, spikes.shape[1])
+    for start in range(0, spikes.shape[0], chunk_size):
+        density.update(spikes[start:start + chunk_size])
+
+    return density.counts
@@ -10,6 +10,7 @@ is worth it or not
 from __future__ import division, print_function, absolute_import
 
 import os
+from multiprocessing import Pool
 import numpy as np
 import tables
 import matplotlib.pyplot as mpl
@@ -19,6 +20,7 @@ from .spike_heatmap import spike_heatmap
 from .plot_cumulative_time import spike_cumulative
 from .. import artifact_id_to_name, get_channels, SortingManagerGrouped
 from .. import h5files
+from ..manager.manager import read_by_index
 
 SIGNS = ('pos', 'neg')
 SPIKES_PER_PLOT = 5000
@@ -36,6 +38,8 @@ GRID_KEYS = {'left': 0,
 YLIM = (-200, 200)
 OVERVIEW = 'overview'
 TEXT_SIZE = 'small'
+# data files and their state when they were plotted
+MANIFEST = 'plotted_files.txt'
 
 
 def make_figure(n_rows):
@@ -88,7 +92,7 @@ def spikes_overview(dirname, save_fname):
     # loop over pos and neg
     for sign in SIGNS:
         try:
-            spikes = fid.get_node('/' + sign + '/spikes')[:, :]
+            spikes = fid.get_node('/' + sign + '/spikes')
         except tables.NoSuchNodeError as error:
             print(error)
             continue
@@ -130,25 +134,25 @@ def spikes_overview(dirname, save_fname):
             if artifacts is not None:
                 current_type = arti_types[type_count]
                 print(current_type)
-                idx = artifacts == current_type
-                current_spikes = spikes[idx, :]
-                current_times = times[idx]
+                idx = (artifacts == current_type).nonzero()[0]
             else:
-                current_spikes = spikes
-                current_times = times
+                idx = np.arange(n_spk)
                 current_type = None
 
-            if current_spikes.shape[0] == 0:
+            if idx.shape[0] == 0:
                 continue
 
-            n_starts = int(np.ceil(current_spikes.shape[0]/SPIKES_PER_PLOT))
+            current_times = times[idx]
+
+            # spikes are read plot by plot
+            n_starts = int(np.ceil(idx.shape[0]/SPIKES_PER_PLOT))
             for start_i in range(0, n_starts):
 
                 plot = fig.add_subplot(grid[plot_count])
                 start = start_i * SPIKES_PER_PLOT
                 stop = start + SPIKES_PER_PLOT
                 print(start, stop)
-                spike_heatmap(plot, current_spikes[start:stop])
+                spike_heatmap(plot, read_by_index(spikes, idx[start:stop]))
                 set_params(plot, x, start == 0)
                 if current_type in artifact_id_to_name:
                     plot.text(x[2], YLIM[0]*.75,
@@ -178,9 +182,10 @@ def process_folder(path):
         spikes_overview(ncs_fname, save_fname)
 
 
-def process_file(fname):
+def overview_fname(fname):
     """
-    run overview on datafiles
+    returns the channel name and the overview name (without sign and .png)
+    of a datafile
     """
     # get the channel name
     # this is dirty code, come up with a better solution
@@ -191,12 +196,80 @@ def process_file(fname):
     except TypeError:
         entity = 'unknown'
     ncs_fname = os.path.basename(fname)[5:-3]
-    print(ncs_fname)
     plot_fname = 'spikes_{}_{}'.format(entity, ncs_fname)
-    save_fname = os.path.join(OVERVIEW, plot_fname)
+    return ncs_fname, os.path.join(OVERVIEW, plot_fname)
+
+
+def overview_images(fname):
+    """
+    images that spikes_overview creates for a datafile
+    """
+    _, save_fname = overview_fname(fname)
+    ret = []
+    fid = tables.open_file(fname, 'r')
+    for sign in SIGNS:
+        try:
+            n_spk = fid.get_node('/' + sign + '/spikes').shape[0]
+        except tables.NoSuchNodeError:
+            continue
+        if n_spk:
+            ret.append(save_fname + '_' + sign + '.png')
+    fid.close()
+    return ret
+
+
+def process_file(fname):
+    """
+    run overview on datafiles
+    """
+    ncs_fname, save_fname = overview_fname(fname)
+    print(ncs_fname)
     spikes_overview(ncs_fname, save_fname)
 
 
+def file_state(fname):
+    """
+    modification time and size of a file
+    """
+    stat = os.stat(fname)
+    return '{:.6f} {}'.format(stat.st_mtime, stat.st_size)
+
+
+def read_manifest():
+    """
+    returns a dictionary of plotted data files and their state
+    """
+    ret = {}
+    fname = os.path.join(OVERVIEW, MANIFEST)
+    if os.path.exists(fname):
+        with open(fname, 'r') as fid:
+            for line in fid:
+                fields = line.rsplit(None, 2)
+                if len(fields) == 3:
+                    ret[fields[0]] = fields[1] + ' ' + fields[2]
+    return ret
+
+
+def write_manifest(manifest):
+    """
+    stores the state of plotted data files
+    """
+    fname = os.path.join(OVERVIEW, MANIFEST)
+    with open(fname, 'w') as fid:
+        for key in sorted(manifest):
+            fid.write('{} {}\n'.format(key, manifest[key]))
+
+
+def _process_file_helper(args):
+    """
+    multiprocessing helper, returns the data file and
+    its state before it was plotted
+    """
+    fname, state = args
+    process_file(fname)
+    return fname, state
+
+
 def parse_args():
     """
     standard arg parsing function
@@ -204,6 +277,11 @@ def parse_args():
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('--datafiles', nargs='+')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of files plotted at the same time')
+    parser.add_argument('--force', default=False, action='store_true',
+                        help='plot all files, also those that did not '
+                             'change since they were plotted')
 
     args = parser.parse_args()
 
@@ -220,5 +298,29 @@ def parse_args():
     else:
         files = h5files(os.getcwd())
 
+    manifest = read_manifest()
+    jobs = []
     for fname in files:
-        process_file(fname)
+        key = os.path.abspath(fname)
+        state = file_state(fname)
+        if (not args.force) and (manifest.get(key) == state) and\
+                all(os.path.exists(image)
+                    for image in overview_images(fname)):
+            print('{} unchanged, not plotting'.format(fname))
+            continue
+        jobs.append((fname, state))
+
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        results = pool.imap_unordered(_process_file_helper, jobs)
+    else:
+        results = (_process_file_helper(job) for job in jobs)
+
+    for fname, state in results:
+        manifest[os.path.abspath(fname)] = state
+        # keep the manifest current if plotting is interrupted
+        write_manifest(manifest)
+
+    if args.workers > 1:
+        pool.close()
+        pool.join()
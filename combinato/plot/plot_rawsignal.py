@@ -7,95 +7,124 @@ impression of the data quality, movement artifacts and so on
 from __future__ import print_function, division, absolute_import
 
 import os
-import sys
 import time
-import subprocess
+from multiprocessing import Pool
 import numpy as np
 import scipy.signal as sig
 import matplotlib.pyplot as mpl
-from matplotlib.gridspec import GridSpec
 
-from .. import NcsFile, DefaultFilter, get_regions
+from .. import NcsFile, DefaultFilter, get_regions, ncs_memmap
 
 MINS = 2
 EVERY_MINS_MIN = 30 # difference can't be below this
 PLOTTIMES = (.5, 30, MINS*60) # in sec
 Q = 1000
+# order of the decimation filter, as in sig.decimate(data, Q, 4)
+Q_ORDER = 4
 DPI = 100
 FIGSIZE = (3.5, .5)
 FONTSIZE = 8
 OVERVIEW_NAME = 'overview'
 TEXT_BBOX = {'facecolor' : 'white', 'lw' : 0}
-GRID = GridSpec(1, 1,
-                left=.01,
-                right=.99,
-                top=.98,
-                bottom=.02,
-                hspace=0,
-                wspace=0)
+# position of the plot in each tile
+TILE_MARGINS = {'left': .01,
+                'right': .99,
+                'top': .98,
+                'bottom': .02}
+N_TILE_COLS = len(PLOTTIMES)
 VERT_ALIGN = {1 : 'top', -1 : 'bottom'}
 
+# filters are designed once per process
+_filters = {}
+
+
+def decimation_filter():
+    """
+    chebyshev lowpass used by sig.decimate, as second-order sections
+    """
+    if 'decimate' not in _filters:
+        _filters['decimate'] = sig.cheby1(Q_ORDER, .05, .8/Q, output='sos')
+    return _filters['decimate']
+
+
+def decimate(data):
+    """
+    the same as sig.decimate(data, Q, Q_ORDER, zero_phase=False),
+    with a cached filter
+    """
+    sos = decimation_filter().astype(data.dtype)
+    return sig.sosfilt(sos, data)[::Q]
+
+
+def default_filter(timestep):
+    """
+    DefaultFilter for timestep, designed once
+    """
+    if timestep not in _filters:
+        _filters[timestep] = DefaultFilter(timestep)
+    return _filters[timestep]
+
+
+def tile_axes(fig, row, col, n_rows):
+    """
+    axes of one tile in a figure of n_rows x N_TILE_COLS tiles
+    """
+    width = 1/N_TILE_COLS
+    height = 1/n_rows
+    left = (col + TILE_MARGINS['left']) * width
+    bottom = (n_rows - row - 1 + TILE_MARGINS['bottom']) * height
+    return fig.add_axes([left,
+                         bottom,
+                         (TILE_MARGINS['right'] - TILE_MARGINS['left'])*width,
+                         (TILE_MARGINS['top'] - TILE_MARGINS['bottom'])*height])
+
 
 def overview_plot(channel):
     """
     Plot sections of the raw signal in order to give a first impression
-    about what's going on during the recording
-    Needs the ImageMagick program 'montage' (available even for window$)
+    about what's going on during the recording.
+    All sections are drawn into one figure, one row per section
     """
-    figs = []
-    plots = []
-    fignames = []
-
     print('Opening %s' % channel)
     fid = NcsFile(channel)
     timestep = fid.timestep
-    total_time = fid.num_recs * 512 * timestep # in seconds
+    num_recs = fid.num_recs
+    header = fid.header
+    del fid
+    records = ncs_memmap(channel)
+    total_time = num_recs * 512 * timestep # in seconds
 
     n_sessions = int(np.ceil(total_time/(60 * EVERY_MINS_MIN)))
 
     if n_sessions < 10:
         n_sessions = 10
 
-    #basename = os.path.splitext(channel)[0]
-
-    #if not os.path.isdir(basename):
-    #    os.mkdir(basename)
-
     if not os.path.isdir(OVERVIEW_NAME):
         os.mkdir(OVERVIEW_NAME)
 
-    overview_tmp = OVERVIEW_NAME
-    #if not os.path.isdir(overview_tmp):
-    #    os.mkdir(overview_tmp)
-
     timefactor = (512*timestep)/60
 
-    voltfactor = fid.header['ADBitVolts'] * 1e6
-    entname = fid.header['AcqEntName']
+    voltfactor = header['ADBitVolts'] * 1e6
+    entname = header['AcqEntName']
     cscname = os.path.basename(channel)[:-4]
-    sessionstarts = np.array(np.linspace(0, fid.num_recs, n_sessions), dtype=int)
-    fignames = []
-    myfilter = DefaultFilter(timestep)
+    sessionstarts = np.array(np.linspace(0, num_recs, n_sessions), dtype=int)
+    myfilter = default_filter(timestep)
     n_recs_load = int(MINS*60/(512*timestep))
 
-    for i in range(3):
-        fig = mpl.figure(figsize=FIGSIZE)
-        plots.append(fig.add_subplot(GRID[0]))
-        figs.append(fig)
+    fig = mpl.figure(figsize=(FIGSIZE[0]*N_TILE_COLS, FIGSIZE[1]*n_sessions))
 
     for sescount in range(n_sessions):
 
         start = sessionstarts[sescount]
         stop = start + n_recs_load
-        if stop >= fid.num_recs:
-            start = fid.num_recs - n_recs_load - 1
-            stop = fid.num_recs - 1
-        data = fid.read(start, stop, 'data').astype(np.float32)
+        if stop >= num_recs:
+            start = num_recs - n_recs_load - 1
+            stop = num_recs - 1
+        data = records['data'][start:stop].astype(np.float32).ravel()
         data *= voltfactor
 
-        for i in range(3):
-            plot = plots[i]
-            plot.cla()
+        for i in range(N_TILE_COLS):
+            plot = tile_axes(fig, sescount, i, n_sessions)
             ptime = PLOTTIMES[i]
             n_samp = int(ptime/timestep)
 
@@ -106,7 +135,7 @@ def overview_plot(channel):
                 pdata = myfilter.filter_detect(data[:n_samp])
 
             elif i == 2:
-                pdata = sig.decimate(data, Q, 4, zero_phase=False)
+                pdata = decimate(data)
 
             x = np.arange(pdata.shape[0])*timestep
 
@@ -126,6 +155,8 @@ def overview_plot(channel):
             plot.set_xticklabels([])
             plot.grid(True, axis='x')
             plot.set_yticks((-ylim, 0, ylim))
+            # tick labels would reach into the neighboring tile
+            plot.set_yticklabels([])
 
             if sescount == 0:
                 if i == 0:
@@ -146,7 +177,6 @@ def overview_plot(channel):
                     plot.text(xpos, sign*ypos, str(sign*ylim) + u' µV', fontsize=FONTSIZE,
                               bbox=TEXT_BBOX, ha='right', va=VERT_ALIGN[sign])
             else:
-                plot.set_yticklabels([])
                 text = '{:.0f} min'.format(start * timefactor)
 
             xpos = x[-1]*.02
@@ -154,36 +184,43 @@ def overview_plot(channel):
             plot.text(xpos, ypos, text, fontsize=FONTSIZE,
                       bbox=TEXT_BBOX)
 
+    del records
 
-            figname = '{}_{:1d}_{:03d}.png'.format(entname, i, sescount)
-            figpath = os.path.join(overview_tmp, figname)
-            fignames.append(figpath)
-            figs[i].savefig(figpath, DPI=DPI)
-
-    mpl.close('all')
-
-    arg = ['montage', '-tile', '3', '-geometry',
-           '{}x{}'.format(FIGSIZE[0]*DPI, FIGSIZE[1]*DPI)] + fignames
-
-    outname = os.path.join('overview',
+    outname = os.path.join(OVERVIEW_NAME,
                            'overview_{}_{}.png'.format(entname, cscname))
-    arg.append(outname)
-    subprocess.call(arg)
-    for figname in fignames:
-        os.remove(figname)
+    fig.savefig(outname, dpi=DPI)
+    mpl.close(fig)
     print('Completed ' + entname)
 
+
 def main():
+    """
+    plot an overview of all channels in a folder
+    """
+    from argparse import ArgumentParser
+    parser = ArgumentParser('css-plot-rawsignal',
+                            description='Plot sections of the raw signal '
+                                        'of all channels in a folder')
+    parser.add_argument('path', nargs='?', default=os.getcwd())
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of channels plotted at the same time')
+    args = parser.parse_args()
+
     t = time.time()
-    if len(sys.argv) > 1:
-        path = sys.argv[1]
-    else:
-        path = os.getcwd()
 
-    my_regions = get_regions(path)
+    my_regions = get_regions(args.path)
     rnames = sorted(my_regions.keys())
-    for i in range(len(rnames)):
-        channels = my_regions[rnames[i]]
+    channels = [ch for rname in rnames for ch in my_regions[rname]]
+
+    if args.workers > 1:
+        # create the folder before workers try to
+        if not os.path.isdir(OVERVIEW_NAME):
+            os.mkdir(OVERVIEW_NAME)
+        pool = Pool(args.workers)
+        pool.map(overview_plot, channels, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
         for ch in channels:
             overview_plot(ch)
 
@@ -14,6 +14,7 @@ from matplotlib.gridspec import GridSpec
 from matplotlib import cm
 
 from .spike_heatmap import spike_heatmap
+from .density import spike_density
 from .. import h5files, Combinato, TYPE_NAMES
 
 LOCAL_TYPE_NAMES = {0: 'NA', 1: 'MU', 2: 'SU', -1: 'Arti'}
@@ -217,12 +218,11 @@ def plot_group(gid, group, group_joined, start_stop, sign,
     plot.set_ylabel(u'µV')
 
     # other density
-    data = np.array([np.histogram(row, bins=DENSITY_BINS)[0]
-                    for row in spikes.T])
+    data = spike_density(spikes, DENSITY_BINS)
     plot = panels['density2']
     plot.cla()
     plot.axis('off')
-    plot.imshow(data.T, aspect='auto', origin='lower', cmap=cm.hot)
+    plot.imshow(data, aspect='auto', origin='lower', cmap=cm.hot)
 
     # now the images
 
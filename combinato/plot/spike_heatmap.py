@@ -6,6 +6,8 @@ from __future__ import absolute_import, division, print_function
 import numpy as np
 from matplotlib.pyplot import cm
 
+from .density import spike_density
+
 cmap = cm.Blues
 
 # idea taken from http://stackoverflow.com/a/14779462
@@ -34,14 +36,9 @@ def spike_heatmap(ax, spikes, x=None, log=False):
     if x is None:
         x = range(nSamp)
 
-    imdata = np.zeros((len(spBins) - 1, nSamp))
-
-    for col in range(nSamp):
-        data = np.histogram(spikes[:, col], bins=spBins)[0]
-        if log:
-            imdata[:, col] = np.log(1 + data)
-        else:
-            imdata[:, col] = data
+    imdata = spike_density(spikes, spBins).astype(float)
+    if log:
+        imdata = np.log(1 + imdata)
 
     ydiff = (spBins[1] - spBins[0])/2.
     extent = [x[0], x[-1], spMin-ydiff, spMax-ydiff]
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+compare a sorting to reference labels,
+e.g. a coreset sorting to a full sorting of the same spikes,
+or any sorting to ground truth labels of a synthetic dataset.
+Sortings are compared after css-combine (groups in sort_cat.h5);
+raw session classes are over-split and mostly unassigned in
+coreset mode, so they say little about sorting quality
+"""
+from __future__ import print_function, division, absolute_import
+import os
+from argparse import ArgumentParser
+import numpy as np
+import tables
+
+from combinato import GROUP_ART, GROUP_NOCLASS
+
+
+def read_labels(sorting_dir):
+    """
+    index and group of each spike of a combined sorting
+    (e.g. sort_pos_joh), 0 for artifacts and unassigned spikes.
+    A session directory is read as classes of sorting.h5
+    """
+    cat_fname = os.path.join(sorting_dir, 'sort_cat.h5')
+    if not os.path.exists(cat_fname):
+        print('{} not found, using session classes'.format(cat_fname))
+        h5fid = tables.open_file(os.path.join(sorting_dir, 'sorting.h5'), 'r')
+        index = h5fid.root.index[:]
+        classes = h5fid.root.classes[:]
+        h5fid.close()
+        return index, classes.astype(int)
+
+    h5fid = tables.open_file(cat_fname, 'r')
+    index = h5fid.root.index[:]
+    classes = h5fid.root.classes[:]
+    groups = h5fid.root.groups[:]
+    h5fid.close()
+
+    group_of = np.zeros(max(classes.max(), groups[:, 0].max()) + 1, int)
+    group_of[groups[:, 0]] = groups[:, 1]
+    labels = group_of[classes]
+    labels[(labels == GROUP_ART) | (labels == GROUP_NOCLASS)] = 0
+
+    return index, labels
+
+
+def compare(reference, test):
+    """
+    assigns each test label to the reference label that most of its
+    spikes have, and scores each reference label by all test labels
+    assigned to it (over-split units are not penalized).
+    Label 0 (unassigned) is never assigned.
+    returns a list of (ref_label, n_test_labels, n_ref, precision, recall)
+    """
+    ref_ids, ref_inv = np.unique(reference, return_inverse=True)
+    test_ids, test_inv = np.unique(test, return_inverse=True)
+
+    confusion = np.zeros((len(ref_ids), len(test_ids)), int)
+    np.add.at(confusion, (ref_inv, test_inv), 1)
+    ref_sizes = confusion.sum(1)
+    test_sizes = confusion.sum(0)
+
+    # majority reference label of each test label
+    majority = confusion.argmax(0)
+    assigned = test_ids != 0
+
+    ret = []
+    for row, ref_id in enumerate(ref_ids):
+        if ref_id == 0:
+            continue
+        cols = (majority == row) & assigned
+        n_shared = confusion[row, cols].sum()
+        n_test = test_sizes[cols].sum()
+        precision = n_shared/n_test if n_test else 0.
+        recall = n_shared/ref_sizes[row]
+        ret.append((ref_id, cols.sum(), ref_sizes[row], precision, recall))
+
+    return ret
+
+
+def main():
+    """
+    parse arguments and print the comparison
+    """
+    parser = ArgumentParser('compare_sortings.py',
+                            description='Compare a sorting to a '
+                                        'reference sorting or to ground '
+                                        'truth labels')
+    parser.add_argument('--sorting', '--session', required=True,
+                        help='sorting directory to evaluate, after '
+                             'css-combine (e.g. sort_pos_joh)')
+    parser.add_argument('--reference',
+                        help='reference sorting directory '
+                             '(same spikes, e.g. without coreset)')
+    parser.add_argument('--labels',
+                        help='text file with one ground truth label per '
+                             'spike of the data file (0: noise)')
+    args = parser.parse_args()
+
+    index, test = read_labels(args.sorting)
+
+    if args.reference is not None:
+        ref_index, reference = read_labels(args.reference)
+        if not np.array_equal(ref_index, index):
+            print('Sortings contain different spikes')
+            return
+    elif args.labels is not None:
+        reference = np.loadtxt(args.labels, dtype=int)[index]
+    else:
+        parser.print_help()
+        return
+
+    print('{} spikes, {:.1%} assigned'.format(len(test), (test > 0).mean()))
+    print('ref label  test labels  n_spikes  precision  recall')
+    for ref_id, n_test, n_ref, precision, recall in compare(reference, test):
+        print('{:9d}  {:11d}  {:8d}  {:9.3f}  {:6.3f}'.
+              format(ref_id, n_test, n_ref, precision, recall))
+
+
+if __name__ == '__main__':
+    main()